@@ -0,0 +1,64 @@
+"""Index decoding speed, in entries per second.
+
+Compares index_read against the slice-and-int.from_bytes decoder it
+replaced, on a synthetic index.
+
+    python benchmarks/bench_index.py [entries]
+"""
+import os
+import sys
+import tempfile
+import time
+from math import ceil
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import libwyag as w
+
+def index_read_slices(raw):
+    """The original decoder: a slice plus int.from_bytes per field."""
+    count = int.from_bytes(raw[8:12], "big")
+    content = raw[12:]
+    idx = 0
+    entries = list()
+    for i in range(0, count):
+        fields = [int.from_bytes(content[idx+o:idx+o+4], "big") for o in range(0, 40, 4)]
+        sha = format(int.from_bytes(content[idx+40:idx+60], "big"), "040x")
+        flags = int.from_bytes(content[idx+60:idx+62], "big")
+        name_length = flags & 0xFFF
+        idx += 62
+        name = content[idx:idx+name_length].decode("utf8")
+        idx += name_length + 1
+        idx = 8 * ceil(idx / 8)
+        entries.append((fields, sha, flags, name))
+    return entries
+
+def make_index(repo, n):
+    entries = list()
+    for i in range(n):
+        name = f"src/module{i // 1000:04d}/pkg{i // 100 % 10}/file{i:07d}.py"
+        entries.append(w.GitIndexEntry(ctime=(1700000000, i), mtime=(1700000000, i),
+                                       dev=1, ino=i, mode_type=0b1000, mode_perms=0o644,
+                                       uid=1000, gid=1000, fsize=i, sha=f"{i:040x}",
+                                       flag_assume_valid=False, flag_stage=0, name=name))
+    w.index_write(repo, w.GitIndex(entries=entries))
+
+def bench(label, n, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {elapsed:8.3f}s {n / elapsed:12,.0f} entries/s")
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmp:
+        repo = w.repo_create(os.path.join(tmp, "repo"))
+        make_index(repo, n)
+        with open(w.repo_file(repo, "index"), "rb") as f:
+            raw = f.read()
+
+        bench("slices (before)", n, lambda: index_read_slices(raw))
+        bench("struct (after)", n, lambda: w.index_read(repo))
+        bench("struct + names", n, lambda: [e.name for e in w.index_read(repo).entries])
+
+if __name__ == "__main__":
+    main()
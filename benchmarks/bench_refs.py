@@ -0,0 +1,64 @@
+"""show-ref and tag lookup time over many tags, loose then packed.
+
+Creates a repository with N loose tags (100000 by default), times
+`wyag show-ref` and resolving a thousand tag names through
+object_resolve, then runs pack-refs and times both again.  Every run
+uses a fresh GitRepository, so the ref cache starts out empty each time.
+
+    python benchmarks/bench_refs.py [tags]
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import libwyag as w
+
+def make_tags(path, n):
+    repo = w.repo_create(path)
+    blob = w.GitBlob(b"tagged\n")
+    sha = w.object_write(blob, repo)
+    tags = os.path.join(repo.gitdir, "refs", "tags")
+    for i in range(n):
+        with open(os.path.join(tags, f"v{i:06d}"), "w") as f:
+            f.write(sha + "\n")
+    return repo.worktree
+
+def timed(label, fn):
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn()
+    print(f"{label:<28} {time.perf_counter() - start:8.3f}s")
+
+def run(worktree, n):
+    def show_ref():
+        os.chdir(worktree)
+        w.cmd_show_ref(None)
+
+    def resolve():
+        repo = w.GitRepository(worktree)
+        for i in range(0, n, max(1, n // 1000)):
+            w.object_resolve(repo, f"v{i:06d}")
+
+    timed("show-ref", show_ref)
+    timed("resolve 1000 tags", resolve)
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        worktree = make_tags(os.path.join(tmp, "repo"), n)
+        try:
+            print(f"{n} loose tags")
+            run(worktree, n)
+            timed("pack-refs", lambda: w.pack_refs(w.GitRepository(worktree)))
+            print(f"{n} packed tags")
+            run(worktree, n)
+        finally:
+            os.chdir(cwd)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""Status time against worktree size.
+
+Builds worktrees of growing size, a quarter of the files untracked, and
+times the index-vs-worktree half of `wyag status` on each.  Time should
+grow linearly.
+
+    python benchmarks/bench_status.py [size ...]
+"""
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import libwyag as w
+
+def make_worktree(path, n):
+    repo = w.repo_create(path)
+    tracked = list()
+    for i in range(n):
+        d = os.path.join(path, f"dir{i // 500:03d}", f"sub{i // 50 % 10}")
+        os.makedirs(d, exist_ok=True)
+        f = os.path.join(d, f"file{i:06d}.txt")
+        with open(f, "w") as fd:
+            fd.write(f"content {i}\n")
+        if i % 4:
+            tracked.append(f)
+    w.add(repo, tracked)
+    return repo
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [1000, 4000, 16000]
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            repo = make_worktree(os.path.join(tmp, "repo"), n)
+            # A first run settles racy entries, time the second.
+            with contextlib.redirect_stdout(io.StringIO()):
+                w.cmd_status_index_worktree(repo, w.index_read(repo))
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                w.cmd_status_index_worktree(repo, w.index_read(repo))
+            elapsed = time.perf_counter() - start
+            print(f"{n:>8} files {elapsed:8.3f}s {elapsed / n * 1e6:8.1f}us/file")
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,22 @@
 import argparse
+import atexit
+from bisect import bisect_left, bisect_right, insort
+import heapq
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import configparser
 from datetime import datetime
 import grp, pwd
-from fnmatch import fnmatch
 import hashlib
 from math import ceil
+import mmap
 import os
 import re
+from stat import S_ISLNK
+import struct
 import sys
+import tempfile
+import time
 import zlib
 
 # Argparse objesini başlatır.
@@ -38,6 +47,19 @@ argsp.add_argument("object",
                    metavar="object",
                    help="The object to display")
 
+# 'diff-tree' komutu
+argsp = argsubparsers.add_parser("diff-tree", help="Compare the content and mode of two trees.")
+argsp.add_argument("-r",
+                   action="store_true",
+                   dest="recursive",
+                   help="Recurse into subtrees.")
+argsp.add_argument("--root",
+                   action="store_true",
+                   help="Show a root commit as adding everything.")
+argsp.add_argument("tree",
+                   nargs="+",
+                   help="A commit, compared to its first parent, or two trees. Paths after -- limit the diff.")
+
 # 'hash-object' komutu
 argsp = argsubparsers.add_parser("hash-object", help="Compute object ID and optionally creates a blob from a file")
 argsp.add_argument("-t",
@@ -55,9 +77,34 @@ argsp.add_argument("path",
 
 argsp = argsubparsers.add_parser("log", help="Display history of a given commit")
 argsp.add_argument("commit",
-                   default="HEAD",
-                   nargs="?",
-                   help="Commit to start at.")
+                   default=["HEAD"],
+                   nargs="*",
+                   help="Commits to start at, A..B for those reachable from B but not A, ^A to exclude A. Paths after -- limit the history to commits changing them.")
+argsp.add_argument("-n",
+                   metavar="number",
+                   dest="limit",
+                   type=int,
+                   default=None,
+                   help="Show at most this many commits.")
+argsp.add_argument("--since",
+                   metavar="date",
+                   default=None,
+                   help="Only commits more recent than a date (YYYY-MM-DD or a unix timestamp).")
+argsp.add_argument("--format",
+                   choices=["graphviz", "text", "oneline"],
+                   default="graphviz",
+                   help="Output format.")
+
+argsp = argsubparsers.add_parser("merge-base", help="Find the best common ancestor of commits.")
+argsp.add_argument("--all",
+                   action="store_true",
+                   help="Print all best common ancestors, not just one.")
+argsp.add_argument("--is-ancestor",
+                   action="store_true",
+                   help="Exit with 0 if the first commit is an ancestor of the second, 1 otherwise.")
+argsp.add_argument("commit",
+                   nargs="+",
+                   help="Commits to compare.")
 
 argsp = argsubparsers.add_parser("ls-tree", help="Pretty-print a tree object.")
 argsp.add_argument("-r",
@@ -73,6 +120,32 @@ argsp.add_argument("path", help="The EMPTY directory to checkout on.")
 
 argsp = argsubparsers.add_parser("show-ref", help="List references.")
 
+argsp = argsubparsers.add_parser("update-ref", help="Update refs safely, all or nothing.")
+argsp.add_argument("-m",
+                   metavar="message",
+                   dest="message",
+                   default="",
+                   help="Reflog message.")
+argsp.add_argument("-d",
+                   action="store_true",
+                   dest="delete",
+                   help="Delete the ref.")
+argsp.add_argument("--stdin",
+                   action="store_true",
+                   help="Read update/create/delete commands from standard input, one per line.")
+argsp.add_argument("ref", nargs="?", help="The ref to update.")
+argsp.add_argument("new", nargs="?", help="Its new value.")
+argsp.add_argument("old", nargs="?", help="The value it must have now (40 zeros if it must not exist).")
+
+argsp = argsubparsers.add_parser("pack-refs", help="Pack refs into packed-refs.")
+argsp.add_argument("--all",
+                   action="store_true",
+                   help="Pack every ref, not only tags and refs already packed.")
+argsp.add_argument("--no-prune",
+                   action="store_false",
+                   dest="prune",
+                   help="Keep the loose files of packed refs.")
+
 argsp = argsubparsers.add_parser("tag",help="List and create tags")
 argsp.add_argument("-a",
                    action="store_true",
@@ -93,7 +166,14 @@ argsp.add_argument("--wyag-type",
                    choices=["blob", "commit", "tag", "tree"],
                    default=None,
                    help="Specify the expected type")
+argsp.add_argument("--short",
+                   metavar="length",
+                   nargs="?",
+                   const="",
+                   default=None,
+                   help="Print the shortest unique abbreviation, at least LENGTH (default: core.abbrev) long.")
 argsp.add_argument("name",
+                   nargs="?",
                    help="The name to parse")
 
 
@@ -113,7 +193,19 @@ argsp.add_argument("path", nargs="+", help="Files to remove")
 
 
 argsp = argsubparsers.add_parser("add", help = "Add files contents to the index.")
-argsp.add_argument("path", nargs="+", help="Files to add")
+argsp.add_argument("-j",
+                   metavar="workers",
+                   dest="workers",
+                   type=int,
+                   default=None,
+                   help="Number of processes hashing files (default: core.workers, or one per CPU).")
+argsp.add_argument("path", nargs="+", help="Files or directories to add")
+
+argsp = argsubparsers.add_parser("commit-graph", help="Write the commit-graph file.")
+argsp.add_argument("action", choices=["write"], help="What to do.")
+argsp.add_argument("--changed-paths",
+                   action="store_true",
+                   help="Also write changed-path Bloom filters (kept by later writes).")
 
 argsp = argsubparsers.add_parser("commit", help="Record changes to the repository.")
 argsp.add_argument("-m",
@@ -121,24 +213,48 @@ argsp.add_argument("-m",
                    dest="message",
                    help="Message to associate with this commit.")
 
+for name in ["gc", "repack"]:
+    argsp = argsubparsers.add_parser(name, help="Pack reachable objects into a delta-compressed pack.")
+    argsp.add_argument("--window",
+                       type=int,
+                       default=10,
+                       help="How many previous objects to try as delta bases.")
+    argsp.add_argument("--depth",
+                       type=int,
+                       default=50,
+                       help="Maximum length of a delta chain.")
+
 def main(argv=sys.argv[1:]):
+    # Paths after "--" in log would otherwise be taken for revisions.
+    paths = list()
+    if argv[:1] in (["log"], ["diff-tree"]) and "--" in argv:
+        i = argv.index("--")
+        argv, paths = argv[:i], argv[i+1:]
     args = argparser.parse_args(argv)
+    args.paths = paths
     match args.command:
         case "add"          : cmd_add(args)
         case "cat-file"     : cmd_cat_file(args)
         case "check-ignore" : cmd_check_ignore(args)
         case "checkout"     : cmd_checkout(args)
         case "commit"       : cmd_commit(args)
+        case "commit-graph" : cmd_commit_graph(args)
+        case "diff-tree"    : cmd_diff_tree(args)
+        case "gc"           : cmd_gc(args)
         case "hash-object"  : cmd_hash_object(args)
         case "init"         : cmd_init(args)
         case "log"          : cmd_log(args)
         case "ls-files"     : cmd_ls_files(args)
         case "ls-tree"      : cmd_ls_tree(args)
+        case "merge-base"   : cmd_merge_base(args)
+        case "pack-refs"    : cmd_pack_refs(args)
+        case "repack"       : cmd_gc(args)
         case "rev-parse"    : cmd_rev_parse(args)
         case "rm"           : cmd_rm(args)
         case "show-ref"     : cmd_show_ref(args)
         case "status"       : cmd_status(args)
         case "tag"          : cmd_tag(args)
+        case "update-ref"   : cmd_update_ref(args)
         case _              : print("Bad command.")
 
 class GitRepository(object):
@@ -147,6 +263,11 @@ class GitRepository(object):
     worktree = None # Çalışma dizinini tutar.
     gitdir = None   # Git verilerini (.git) tutar.
     conf = None     # config dosyası.
+    packs = None    # objects/pack altındaki packfile'lar, ilk kullanımda yüklenir.
+    commit_graph = None # objects/info/commit-graph; yoksa False.
+    sha_index = None    # Kısaltılmış SHA aramaları için sıralı nesne listesi.
+    refs = None         # Loose ve packed ref'ler, ilk kullanımda yüklenir.
+    object_cache = None # Okunan nesnelerin LRU önbelleği.
 
     def __init__(self, path, force=False):
         self.worktree = os.path.realpath(path)
@@ -168,6 +289,11 @@ class GitRepository(object):
             if vers != 0:
                 raise Exception(f"Unsupported repositoryformatversion: {vers}")
 
+        self.object_cache = ObjectCache(
+            self.conf.getint("core", "objectcachesize", fallback=OBJECT_CACHE_SIZE))
+        if os.environ.get("WYAG_CACHE_STATS"):
+            atexit.register(self.object_cache.report)
+
 def repo_path(repo, *path):
     return os.path.join(repo.gitdir, *path)
 
@@ -183,7 +309,8 @@ def repo_dir(repo, *path, mkdir=False):
         else:
             raise Exception(f"Not a directory {path}")
     if mkdir:
-        os.makedirs(path)
+        # Another process (add's workers...) may create it meanwhile.
+        os.makedirs(path, exist_ok=True)
         return path
     else:
         return None
@@ -232,8 +359,9 @@ def cmd_cat_file(args):
     cat_file(repo, args.object, fmt=args.type.encode())
 
 def cat_file(repo, obj, fmt=None):
-    obj = object_read(repo, object_find(repo, obj, fmt=fmt))
-    sys.stdout.buffer.write(obj.serialize())
+    _, _, chunks = object_read_stream(repo, object_find(repo, obj, fmt=fmt))
+    for chunk in chunks:
+        sys.stdout.buffer.write(chunk)
 
 def repo_find(path='.', required=True):
     path = os.path.realpath(path)
@@ -276,7 +404,89 @@ class GitBlob(GitObject):
     def deserialize(self, data):
         self.blobdata = data
 
-def object_read(repo, sha):
+# Default byte budget of a repository's object cache.  Override with
+# core.objectCacheSize.
+OBJECT_CACHE_SIZE = 64 * 1024 * 1024
+
+class ObjectCache(object):
+    """LRU cache of inflated objects, bounded by their total size in bytes.
+
+    Each entry holds the raw (fmt, data) pair and, once someone asked
+    for it, the parsed GitObject.  Parsed objects are shared, so callers
+    must not modify what object_read returns."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.entries = OrderedDict() # sha -> [fmt, data, obj]
+        self.hits = 0          # Raw lookups served from the cache
+        self.misses = 0        # Raw lookups that went to disk
+        self.parsed_hits = 0   # object_read calls that skipped parsing
+        self.parsed_misses = 0
+        self.evictions = 0
+
+    def get(self, sha):
+        entry = self.entries.get(sha)
+        if entry is not None:
+            self.entries.move_to_end(sha)
+        return entry
+
+    def put(self, sha, fmt, data):
+        if len(data) > self.budget:
+            return
+        self.entries[sha] = [fmt, data, None]
+        self.size += len(data)
+        self.shrink()
+
+    def put_parsed(self, sha, obj):
+        entry = self.entries.get(sha)
+        if entry is not None and entry[2] is None:
+            entry[2] = obj
+            # Rough cost of the parsed copy: as much as the raw data.
+            self.size += len(entry[1])
+            self.shrink()
+
+    def shrink(self):
+        while self.size > self.budget and self.entries:
+            _, (_, data, obj) = self.entries.popitem(last=False)
+            self.size -= len(data) if obj is None else 2 * len(data)
+            self.evictions += 1
+
+    def stats(self):
+        return {"budget": self.budget,
+                "size": self.size,
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "parsed_hits": self.parsed_hits,
+                "parsed_misses": self.parsed_misses,
+                "evictions": self.evictions}
+
+    def report(self):
+        print("object cache: " + ", ".join(f"{k}={v}" for k, v in self.stats().items()),
+              file=sys.stderr)
+
+def object_read_raw(repo, sha):
+    """Return the (fmt, data) pair for object SHA, or None if it doesn't exist."""
+    cache = repo.object_cache
+    if cache is not None:
+        entry = cache.get(sha)
+        if entry is not None:
+            cache.hits += 1
+            return entry[0], entry[1]
+        cache.misses += 1
+
+    raw = object_read_disk(repo, sha)
+    if raw is not None and cache is not None:
+        cache.put(sha, raw[0], raw[1])
+    return raw
+
+def object_read_disk(repo, sha):
+    for pack in pack_list(repo):
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack.read(offset)
+
     path = repo_file(repo, "objects", sha[0:2], sha[2:])
 
     if not os.path.isfile(path):
@@ -293,19 +503,140 @@ def object_read(repo, sha):
     if size != len(raw) - y - 1:
         raise Exception(f"Malformed object {sha}: bad length")
 
+    return fmt, raw[y+1:]
+
+def inflate_stream(read):
+    """Yield the inflated content of the zlib stream returned by
+    successive READ() calls, at most STREAM_CHUNK bytes at a time."""
+    d = zlib.decompressobj()
+    pending = b''
+    while True:
+        if not pending:
+            if d.eof:
+                return
+            pending = read(STREAM_CHUNK)
+            if not pending:
+                return
+        out = d.decompress(pending, STREAM_CHUNK)
+        pending = d.unconsumed_tail
+        if out:
+            yield out
+
+def stream_checked(chunks, size, sha):
+    """Pass CHUNKS through, failing if they don't add up to SIZE bytes."""
+    seen = 0
+    for chunk in chunks:
+        seen += len(chunk)
+        yield chunk
+    if seen != size:
+        raise Exception(f"Malformed object {sha}: bad length")
+
+def object_read_stream(repo, sha):
+    """Open object SHA for streaming.  Returns (fmt, size, chunks), where
+    CHUNKS yields the body in bounded pieces, or None if SHA doesn't
+    exist."""
+    cache = repo.object_cache
+    if cache is not None:
+        entry = cache.get(sha)
+        if entry is not None:
+            cache.hits += 1
+            return entry[0], len(entry[1]), iter([entry[1]])
+
+    for pack in pack_list(repo):
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack.read_stream(offset, sha)
+
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    if not os.path.isfile(path):
+        return None
+
+    f = open(path, "rb")
+    stream = inflate_stream(f.read)
+
+    # The header is tiny, it nearly always fits in the first chunk.
+    head = b''
+    for chunk in stream:
+        head += chunk
+        if b'\x00' in head:
+            break
+    x = head.find(b' ')
+    y = head.find(b'\x00')
+    if x < 0 or y < 0:
+        f.close()
+        raise Exception(f"Malformed object {sha}: bad header")
+    fmt = head[0:x]
+    size = int(head[x+1:y].decode("ascii"))
+    body = head[y+1:]
+
+    def chunks():
+        with f:
+            if body:
+                yield body
+            yield from stream
+
+    return fmt, size, stream_checked(chunks(), size, sha)
+
+def object_read_type(repo, sha):
+    """The fmt of object SHA, or None if it doesn't exist.  Only the
+    header is inflated."""
+    cache = repo.object_cache
+    if cache is not None:
+        entry = cache.get(sha)
+        if entry is not None:
+            return entry[0]
+
+    for pack in pack_list(repo):
+        offset = pack.find(sha)
+        if offset is not None:
+            return pack.read_type(offset)
+
+    path = repo_file(repo, "objects", sha[0:2], sha[2:])
+    if not os.path.isfile(path):
+        return None
+
+    with open(path, "rb") as f:
+        head = b''
+        for chunk in inflate_stream(lambda n: f.read(min(n, 64))):
+            head += chunk
+            if b'\x00' in head:
+                break
+    x = head.find(b' ')
+    if x < 0 or b'\x00' not in head:
+        raise Exception(f"Malformed object {sha}: bad header")
+    return head[0:x]
+
+def object_class(fmt, sha=None):
     match fmt:
         case b'commit':
-            c = GitCommit
+            return GitCommit
         case b'tree':
-            c = GitTree
+            return GitTree
         case b'tag':
-            c = GitTag
+            return GitTag
         case b'blob':
-            c = GitBlob
+            return GitBlob
         case _:
             raise Exception(f"Unknown type {fmt.decode('ascii')} for object {sha}")
 
-    return c(raw[y+1:])
+def object_read(repo, sha):
+    cache = repo.object_cache
+    if cache is not None:
+        entry = cache.get(sha)
+        if entry is not None and entry[2] is not None:
+            cache.parsed_hits += 1
+            return entry[2]
+        cache.parsed_misses += 1
+
+    raw = object_read_raw(repo, sha)
+    if raw is None:
+        return None
+
+    fmt, data = raw
+    obj = object_class(fmt, sha)(data)
+    if cache is not None:
+        cache.put_parsed(sha, obj)
+    return obj
 
 def object_write(obj, repo=None):
     data = obj.serialize()
@@ -314,16 +645,422 @@ def object_write(obj, repo=None):
 
     if repo:
         path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
-        if not os.path.exists(path):
+        if not os.path.exists(path) and not pack_contains(repo, sha):
             with open(path, 'wb') as f:
                 f.write(zlib.compress(result))
+            sha_index_add(repo, sha)
 
     return sha
 
+# Packfile type codes.  5 is reserved, 6 and 7 are deltas against
+# another object (by offset in the same pack, or by SHA).
+PACK_OBJ_TYPES = {1: b'commit', 2: b'tree', 3: b'blob', 4: b'tag'}
+PACK_OBJ_OFS_DELTA = 6
+PACK_OBJ_REF_DELTA = 7
+
+class GitPack(object):
+    """A packfile and its version 2 .idx"""
+
+    path = None   # Path to the .pack file
+    count = None  # Number of objects in the pack
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path[:-5] + ".idx", "rb") as f:
+            idx = f.read()
+
+        if idx[:4] != b"\xfftOc":
+            raise Exception(f"Unsupported pack index (v1?) for {path}")
+        version = int.from_bytes(idx[4:8], "big")
+        if version != 2:
+            raise Exception(f"Unsupported pack index version {version} for {path}")
+
+        # fanout[b] is the number of objects whose first SHA byte is <= b.
+        self.fanout = struct.unpack_from(">256L", idx, 8)
+        self.count = self.fanout[255]
+        self.idx = idx
+        self.sha_table = 8 + 256 * 4
+        self.crc_table = self.sha_table + 20 * self.count
+        self.offset_table = self.crc_table + 4 * self.count
+        self.large_offset_table = self.offset_table + 4 * self.count
+
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.data)
+
+        if self.data[:4] != b"PACK":
+            raise Exception(f"Not a packfile: {path}")
+
+    def sha_at(self, i):
+        start = self.sha_table + 20 * i
+        return self.idx[start:start+20]
+
+    def offset_at(self, i):
+        offset = int.from_bytes(self.idx[self.offset_table + 4*i:self.offset_table + 4*i + 4], "big")
+        # MSB set means the real offset is in the 64-bit table.
+        if offset & 0x80000000:
+            start = self.large_offset_table + 8 * (offset & 0x7fffffff)
+            offset = int.from_bytes(self.idx[start:start+8], "big")
+        return offset
+
+    def bounds(self, first_byte):
+        """Range of SHA table positions whose first byte is FIRST_BYTE."""
+        lo = self.fanout[first_byte - 1] if first_byte else 0
+        return lo, self.fanout[first_byte]
+
+    def find(self, sha):
+        """Return the pack offset of SHA, or None."""
+        target = bytes.fromhex(sha)
+        lo, hi = self.bounds(target[0])
+        while lo < hi:
+            mid = (lo + hi) // 2
+            cur = self.sha_at(mid)
+            if cur < target:
+                lo = mid + 1
+            elif cur > target:
+                hi = mid
+            else:
+                return self.offset_at(mid)
+        return None
+
+    def find_prefix(self, prefix):
+        """Every SHA in this pack starting with the hex string PREFIX."""
+        lo, hi = self.bounds(int(prefix[0:2], 16))
+        ret = list()
+        for i in range(lo, hi):
+            sha = self.sha_at(i).hex()
+            if sha.startswith(prefix):
+                ret.append(sha)
+        return ret
+
+    def object_header(self, offset):
+        """Parse the type/size varint at OFFSET.  Returns (type, size, data offset)."""
+        data = self.data
+        c = data[offset]
+        offset += 1
+        type = (c >> 4) & 0b111
+        size = c & 0b1111
+        shift = 4
+        while c & 0x80:
+            c = data[offset]
+            offset += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        return type, size, offset
+
+    def inflate(self, offset, size):
+        d = zlib.decompressobj()
+        out = list()
+        while not d.eof:
+            chunk = self.view[offset:offset + 65536]
+            if not chunk:
+                raise Exception(f"Truncated object in {self.path}")
+            out.append(d.decompress(chunk))
+            offset += len(chunk)
+        ret = b''.join(out)
+        if len(ret) != size:
+            raise Exception(f"Malformed object in {self.path}: bad length")
+        return ret
+
+    def read_stream(self, offset, sha=None):
+        """Like read, but returns (fmt, size, chunks).  Only undeltified
+        objects are actually streamed; deltas need their whole base."""
+        type, size, pos = self.object_header(offset)
+        if type in PACK_OBJ_TYPES:
+            def read(n):
+                nonlocal pos
+                chunk = self.view[pos:pos + n]
+                pos += len(chunk)
+                return chunk
+            return PACK_OBJ_TYPES[type], size, stream_checked(inflate_stream(read), size, sha)
+
+        fmt, data = self.read(offset)
+        return fmt, len(data), iter([data])
+
+    def read_type(self, offset):
+        """The fmt of the object at OFFSET.  Delta chains are followed
+        through their headers down to the base; nothing is inflated."""
+        while True:
+            type, size, pos = self.object_header(offset)
+            if type in PACK_OBJ_TYPES:
+                return PACK_OBJ_TYPES[type]
+            elif type == PACK_OBJ_OFS_DELTA:
+                rel, pos = offset_varint_read(self.data, pos)
+                offset = offset - rel
+            elif type == PACK_OBJ_REF_DELTA:
+                base = self.data[pos:pos+20].hex()
+                offset = self.find(base)
+                if offset is None:
+                    raise Exception(f"Delta base {base} missing from {self.path}")
+            else:
+                raise Exception(f"Unknown object type {type} in {self.path}")
+
+    def read(self, offset):
+        """Return the (fmt, data) pair stored at OFFSET, resolving deltas."""
+        deltas = list()
+
+        while True:
+            type, size, pos = self.object_header(offset)
+
+            if type in PACK_OBJ_TYPES:
+                fmt = PACK_OBJ_TYPES[type]
+                data = self.inflate(pos, size)
+                break
+            elif type == PACK_OBJ_OFS_DELTA:
+                # Negative offset to the base.
+                rel, pos = offset_varint_read(self.data, pos)
+                deltas.append(self.inflate(pos, size))
+                offset = offset - rel
+            elif type == PACK_OBJ_REF_DELTA:
+                base = self.data[pos:pos+20].hex()
+                deltas.append(self.inflate(pos + 20, size))
+                offset = self.find(base)
+                if offset is None:
+                    raise Exception(f"Delta base {base} missing from {self.path}")
+            else:
+                raise Exception(f"Unknown object type {type} in {self.path}")
+
+        for delta in reversed(deltas):
+            data = delta_apply(data, delta)
+
+        return fmt, data
+
+def offset_varint_read(data, pos):
+    """Read a number in git's "offset encoding", a big-endian varint
+    where every continuation byte adds one before shifting.  Returns the
+    number and the position after it."""
+    c = data[pos]
+    pos += 1
+    ret = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        ret = ((ret + 1) << 7) | (c & 0x7f)
+    return ret, pos
+
+def delta_varint(delta, pos):
+    ret = 0
+    shift = 0
+    while True:
+        c = delta[pos]
+        pos += 1
+        ret |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return pos, ret
+
+def delta_apply(base, delta):
+    pos, src_size = delta_varint(delta, 0)
+    pos, dst_size = delta_varint(delta, pos)
+
+    if src_size != len(base):
+        raise Exception("Malformed delta: base size mismatch")
+
+    out = bytearray()
+    while pos < len(delta):
+        cmd = delta[pos]
+        pos += 1
+        if cmd & 0x80:
+            # Copy from base.  The low 4 bits say which offset bytes
+            # follow, the next 3 bits which size bytes follow.
+            offset = 0
+            size = 0
+            for i in range(4):
+                if cmd & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if cmd & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            if size == 0:
+                size = 0x10000
+            out += base[offset:offset+size]
+        elif cmd:
+            # Insert the next CMD bytes literally.
+            out += delta[pos:pos+cmd]
+            pos += cmd
+        else:
+            raise Exception("Malformed delta: reserved opcode 0")
+
+    if len(out) != dst_size:
+        raise Exception("Malformed delta: result size mismatch")
+
+    return bytes(out)
+
+def pack_contains(repo, sha):
+    for pack in pack_list(repo):
+        if pack.find(sha) is not None:
+            return True
+    return False
+
+def object_exists(repo, sha):
+    """Whether object SHA is in REPO, loose or packed, without reading it."""
+    return (os.path.isfile(repo_path(repo, "objects", sha[0:2], sha[2:]))
+            or pack_contains(repo, sha))
+
+def pack_list(repo):
+    if repo.packs is None:
+        repo.packs = list()
+        path = repo_dir(repo, "objects", "pack")
+        if path:
+            for f in sorted(os.listdir(path)):
+                if f.endswith(".pack") and os.path.exists(os.path.join(path, f[:-5] + ".idx")):
+                    repo.packs.append(GitPack(os.path.join(path, f)))
+    return repo.packs
+
+
 def object_find(repo, name, fmt=None, follow=True):
     return name
 
+class GitShaIndex(object):
+    """Sorted binary SHAs of every object, loose and packed, so short
+    hashes resolve and abbreviate with a bisect instead of listing
+    directories.  Built on first use: one listdir per fan-out directory
+    and a copy of each pack's SHA table."""
+
+    def __init__(self, repo):
+        shas = list()
+
+        objects = repo_dir(repo, "objects")
+        if objects:
+            for d in os.listdir(objects):
+                if len(d) != 2:
+                    continue
+                for f in os.listdir(os.path.join(objects, d)):
+                    if len(f) == 38:
+                        try:
+                            shas.append(bytes.fromhex(d + f))
+                        except ValueError:
+                            pass # Not an object (tmp_obj_..., garbage)
+
+        for pack in pack_list(repo):
+            table = pack.idx[pack.sha_table:pack.sha_table + 20 * pack.count]
+            shas.extend(table[i:i+20] for i in range(0, len(table), 20))
+
+        # Each pack is a sorted run already, which sort() merges quickly.
+        shas.sort()
+        self.shas = [sha for i, sha in enumerate(shas) if i == 0 or shas[i-1] != sha]
+
+    def add(self, sha):
+        raw = bytes.fromhex(sha)
+        i = bisect_left(self.shas, raw)
+        if i == len(self.shas) or self.shas[i] != raw:
+            self.shas.insert(i, raw)
+
+    def find_prefix(self, prefix):
+        """Every SHA starting with the hex string PREFIX."""
+        pad = 40 - len(prefix)
+        lo = bisect_left(self.shas, bytes.fromhex(prefix + "0" * pad))
+        hi = bisect_right(self.shas, bytes.fromhex(prefix + "f" * pad))
+        return [sha.hex() for sha in self.shas[lo:hi]]
+
+    def abbrev(self, sha, length):
+        """Shortest prefix of SHA, at least LENGTH long, that no other
+        object shares."""
+        raw = bytes.fromhex(sha)
+        value = int.from_bytes(raw, "big")
+        i = bisect_left(self.shas, raw)
+        # Only the neighbours in sort order can share a longer prefix.
+        for j in (i - 1, i, i + 1):
+            if 0 <= j < len(self.shas) and self.shas[j] != raw:
+                other = int.from_bytes(self.shas[j], "big")
+                common = 40 - ((value ^ other).bit_length() + 3) // 4
+                length = max(length, common + 1)
+        return sha[:min(length, 40)]
+
+def sha_index_get(repo):
+    if repo.sha_index is None:
+        repo.sha_index = GitShaIndex(repo)
+    return repo.sha_index
+
+def sha_index_add(repo, sha):
+    """Record a newly written object, if the index is already built."""
+    if repo.sha_index is not None:
+        repo.sha_index.add(sha)
+
+# Shortest abbreviation core.abbrev=auto ever picks, like git.
+ABBREV_MIN = 7
+
+def repo_abbrev_length(repo):
+    """Minimum abbreviated SHA length from core.abbrev: a number, "no"
+    for full SHAs, or "auto" (the default), which grows with the object
+    count so that abbreviations rarely need to be lengthened."""
+    value = repo.conf.get("core", "abbrev", fallback="auto").strip().lower()
+    if value in ("no", "false", "off"):
+        return 40
+    if value != "auto":
+        return max(4, min(40, int(value)))
+    count = len(sha_index_get(repo).shas)
+    return max(ABBREV_MIN, (count.bit_length() + 1) // 2)
+
+def object_abbrev(repo, sha, length=None):
+    """Shortest unique abbreviation of SHA, at least LENGTH (by default
+    core.abbrev) hex digits long."""
+    if length is None:
+        length = repo_abbrev_length(repo)
+    return sha_index_get(repo).abbrev(sha, length)
+
+# Size of the chunks streamed through SHA-1 and zlib.
+STREAM_CHUNK = 1024 * 1024
+
+def blob_hash_stream(fd, repo=None):
+    """Hash (and, with REPO, write) the blob read from FD in constant
+    memory.  FD must be a real file: its size goes in the header before
+    any data is read."""
+    size = os.fstat(fd.fileno()).st_size
+    header = b'blob ' + str(size).encode() + b'\x00'
+    sha1 = hashlib.sha1(header)
+
+    tmp = None
+    if repo:
+        objects = repo_dir(repo, "objects", mkdir=True)
+        tmp_fd, tmp = tempfile.mkstemp(prefix="tmp_obj_", dir=objects)
+        out = os.fdopen(tmp_fd, "wb")
+        compressor = zlib.compressobj()
+        out.write(compressor.compress(header))
+
+    try:
+        read = 0
+        while True:
+            chunk = fd.read(STREAM_CHUNK)
+            if not chunk:
+                break
+            read += len(chunk)
+            sha1.update(chunk)
+            if tmp:
+                out.write(compressor.compress(chunk))
+
+        if read != size:
+            raise Exception(f"File changed while hashing: expected {size} bytes, read {read}")
+
+        sha = sha1.hexdigest()
+
+        if tmp:
+            out.write(compressor.flush())
+            # mkstemp makes it 0600; objects are read-only to everyone,
+            # like git's.
+            os.fchmod(out.fileno(), 0o444)
+            out.close()
+            path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+            if os.path.exists(path) or pack_contains(repo, sha):
+                os.unlink(tmp)
+            else:
+                os.replace(tmp, path)
+                sha_index_add(repo, sha)
+            tmp = None
+    finally:
+        if tmp:
+            out.close()
+            os.unlink(tmp)
+
+    return sha
+
 def object_hash(fd, fmt, repo=None):
+    if fmt == b'blob':
+        return blob_hash_stream(fd, repo)
+
     data = fd.read()
 
     match fmt:
@@ -413,46 +1150,614 @@ class GitCommit(GitObject):
     def init(self):
         self.kvlm = dict()
 
-# Komut satırı log fonksiyonu.
-def cmd_log(args):
-    repo = repo_find()
-    print("digraph wyaglog{")
-    print("  node[shape=rect]")
-    # Grafik oluşturma fonksiyonunu çağır.
-    log_graphviz(repo, object_find(repo, args.commit), set())
-    print("}")
+def commit_parents(commit):
+    """Parent SHAs of COMMIT, in order."""
+    parents = commit.kvlm.get(b'parent', [])
+    if type(parents) != list:
+        parents = [parents]
+    return [p.decode("ascii") for p in parents]
+
+def commit_date(commit):
+    """Committer timestamp of COMMIT, in seconds since the epoch."""
+    committer = commit.kvlm.get(b'committer') or commit.kvlm.get(b'author')
+    if type(committer) == list:
+        committer = committer[0]
+    try:
+        return int(committer.rsplit(b' ', 2)[1])
+    except (AttributeError, IndexError, ValueError):
+        return 0
+
+# Generation of a commit the commit-graph doesn't know: larger than any
+# real one, so cutoffs never skip it.
+GENERATION_INFINITY = 0xffffffff
+
+GRAPH_PARENT_NONE = 0x70000000
+GRAPH_EXTRA_EDGES = 0x80000000
+
+class GitCommitGraph(object):
+    """objects/info/commit-graph: every commit's parents, root tree,
+    generation number and date, so history can be walked without
+    inflating commits.  Same file format as git's."""
+
+    path = None
+    count = None  # Number of commits in the graph
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        data = self.data
+
+        if data[:4] != b"CGPH":
+            raise Exception(f"Not a commit-graph: {path}")
+        if data[4] != 1 or data[5] != 1:
+            raise Exception(f"Unsupported commit-graph version {data[4]} (hash {data[5]}) in {path}")
+
+        self.chunks = dict()
+        for i in range(data[6]):
+            id, offset = struct.unpack_from(">4sQ", data, 8 + 12 * i)
+            self.chunks[id] = offset
+
+        for id in (b"OIDF", b"OIDL", b"CDAT"):
+            if id not in self.chunks:
+                raise Exception(f"commit-graph {path} has no {id.decode()} chunk")
+
+        self.fanout = struct.unpack_from(">256L", data, self.chunks[b"OIDF"])
+        self.count = self.fanout[255]
+        self.oid_table = self.chunks[b"OIDL"]
+        self.data_table = self.chunks[b"CDAT"]
+        self.edge_table = self.chunks.get(b"EDGE")
+
+        # Changed-path Bloom filters, if the graph was written with them.
+        self.bloom_index = self.chunks.get(b"BIDX")
+        self.bloom_table = None
+        if self.bloom_index is not None and b"BDAT" in self.chunks:
+            version, hashes, bits = struct.unpack_from(">LLL", data, self.chunks[b"BDAT"])
+            if version == 1:
+                self.bloom_table = self.chunks[b"BDAT"] + 12
+                self.bloom_hashes = hashes
+                self.bloom_bits = bits
+        self.bloom_stats = {"queries": 0,        # Filters consulted
+                            "definitely_not": 0, # Tree diffs skipped
+                            "maybe": 0,
+                            "false_positives": 0, # "maybe", but the path was unchanged
+                            "no_filter": 0}      # Commits the filters don't cover
+
+    def sha_at(self, pos):
+        start = self.oid_table + 20 * pos
+        return self.data[start:start+20].hex()
+
+    def find(self, sha):
+        """Position of SHA in the graph, or None."""
+        target = bytes.fromhex(sha)
+        lo = self.fanout[target[0] - 1] if target[0] else 0
+        hi = self.fanout[target[0]]
+        data = self.data
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.oid_table + 20 * mid
+            cur = data[start:start+20]
+            if cur < target:
+                lo = mid + 1
+            elif cur > target:
+                hi = mid
+            else:
+                return mid
+        return None
 
-# Commit geçmişini Graphviz formatında görselleştirir.
-def log_graphviz(repo, sha, seen):
-    # Daha önce işlenmişse dur.
-    if sha in seen:
-        return
-    seen.add(sha)
+    def tree_at(self, pos):
+        start = self.data_table + 36 * pos
+        return self.data[start:start+20].hex()
+
+    def parents_at(self, pos):
+        """Graph positions of the parents of the commit at POS."""
+        p1, p2, gen, date = struct.unpack_from(">LLLL", self.data, self.data_table + 36 * pos + 20)
+        if p1 == GRAPH_PARENT_NONE:
+            return []
+        if p2 == GRAPH_PARENT_NONE:
+            return [p1]
+        if not p2 & GRAPH_EXTRA_EDGES:
+            return [p1, p2]
+
+        # Octopus: p2 indexes a list in EDGE, whose last entry has the MSB set.
+        ret = [p1]
+        i = p2 & ~GRAPH_EXTRA_EDGES
+        while True:
+            e, = struct.unpack_from(">L", self.data, self.edge_table + 4 * i)
+            ret.append(e & ~GRAPH_EXTRA_EDGES)
+            if e & GRAPH_EXTRA_EDGES:
+                return ret
+            i += 1
+
+    def generation_at(self, pos):
+        word, = struct.unpack_from(">L", self.data, self.data_table + 36 * pos + 28)
+        return word >> 2
+
+    def date_at(self, pos):
+        high, low = struct.unpack_from(">LL", self.data, self.data_table + 36 * pos + 28)
+        return ((high & 0b11) << 32) | low
+
+    def bloom_at(self, pos):
+        """The changed-path filter of the commit at POS, or None."""
+        if self.bloom_table is None:
+            return None
+        end, = struct.unpack_from(">L", self.data, self.bloom_index + 4 * pos)
+        start = 0
+        if pos:
+            start, = struct.unpack_from(">L", self.data, self.bloom_index + 4 * (pos - 1))
+        return self.data[self.bloom_table + start:self.bloom_table + end]
+
+    def report(self):
+        print("bloom filters: " + ", ".join(f"{k}={v}" for k, v in self.bloom_stats.items()),
+              file=sys.stderr)
+
+def commit_graph_get(repo):
+    """The repository's commit-graph, or None if it hasn't got one."""
+    if repo.commit_graph is None:
+        path = repo_path(repo, "objects", "info", "commit-graph")
+        repo.commit_graph = GitCommitGraph(path) if os.path.isfile(path) else False
+        if repo.commit_graph and os.environ.get("WYAG_BLOOM_STATS"):
+            atexit.register(repo.commit_graph.report)
+    return repo.commit_graph or None
+
+def commit_tree(repo, sha):
+    """Root tree SHA of the commit SHA."""
+    graph = commit_graph_get(repo)
+    if graph:
+        pos = graph.find(sha)
+        if pos is not None:
+            return graph.tree_at(pos)
+    return object_read(repo, sha).kvlm[b'tree'].decode("ascii")
+
+# Changed-path Bloom filters, as git writes them (version 1): every path
+# a commit changed relative to its first parent, with its leading
+# directories, is set in a per-commit filter of BLOOM_BITS_PER_ENTRY
+# bits per path using BLOOM_HASHES hash functions.  Commits that changed
+# more than BLOOM_MAX_CHANGES paths get a single all-ones byte.
+BLOOM_HASHES = 7
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_MAX_CHANGES = 512
+BLOOM_SEED0 = 0x293ae76f
+BLOOM_SEED1 = 0x7e646e2c
+
+def murmur3_v1(data, seed):
+    """32-bit murmur3 as git's version 1 filters compute it: bytes are
+    read as (signed) chars, so those >= 0x80 are sign-extended."""
+    c1, c2 = 0xcc9e2d51, 0x1b873593
+    mask = 0xffffffff
+
+    def byte(i):
+        b = data[i]
+        return b | 0xffffff00 if b & 0x80 else b
+
+    h = seed
+    n = len(data) - len(data) % 4
+    for i in range(0, n, 4):
+        k = byte(i) | (byte(i+1) << 8) | (byte(i+2) << 16) | (byte(i+3) << 24)
+        k = (k * c1) & mask
+        k = ((k << 15) | (k >> 17)) & mask
+        k = (k * c2) & mask
+        h ^= k
+        h = ((h << 13) | (h >> 19)) & mask
+        h = (h * 5 + 0xe6546b64) & mask
+
+    k = 0
+    tail = len(data) & 3
+    if tail == 3:
+        k ^= (byte(n+2) << 16) & mask
+    if tail >= 2:
+        k ^= (byte(n+1) << 8) & mask
+    if tail >= 1:
+        k ^= byte(n)
+        k = (k * c1) & mask
+        k = ((k << 15) | (k >> 17)) & mask
+        k = (k * c2) & mask
+        h ^= k
+
+    h ^= len(data)
+    h ^= h >> 16
+    h = (h * 0x85ebca6b) & mask
+    h ^= h >> 13
+    h = (h * 0xc2b2ae35) & mask
+    h ^= h >> 16
+    return h
+
+def bloom_key(path, hashes=BLOOM_HASHES):
+    """The HASHES hash values of PATH (a str, no trailing slash)."""
+    raw = path.encode("utf8")
+    h0 = murmur3_v1(raw, BLOOM_SEED0)
+    h1 = murmur3_v1(raw, BLOOM_SEED1)
+    return [(h0 + i * h1) & 0xffffffff for i in range(hashes)]
+
+def bloom_keys(path, hashes=BLOOM_HASHES):
+    """Keys for PATH and each of its leading directories, which a filter
+    has to contain all of for PATH to have maybe changed."""
+    parts = path.split("/")
+    return [bloom_key("/".join(parts[:i]), hashes) for i in range(len(parts), 0, -1)]
+
+def bloom_add(filter, key):
+    bits = len(filter) * 8
+    for h in key:
+        b = h % bits
+        filter[b // 8] |= 1 << (b % 8)
+
+def bloom_contains(filter, key):
+    bits = len(filter) * 8
+    for h in key:
+        b = h % bits
+        if not filter[b // 8] & (1 << (b % 8)):
+            return False
+    return True
+
+def commit_touches(repo, sha, parents, paths):
+    """Whether commit SHA changed any of PATHS.  Like git's history
+    simplification, a merge only counts if it differs from every parent.
+    The first parent is checked against the Bloom filter, when there is
+    one, before any tree is read."""
+    graph = commit_graph_get(repo)
+    maybe = False
+    if parents and graph and graph.bloom_table is not None:
+        pos = graph.find(sha)
+        filter = graph.bloom_at(pos) if pos is not None else None
+        if filter:
+            graph.bloom_stats["queries"] += 1
+            if not any(all(bloom_contains(filter, key) for key in bloom_keys(path, graph.bloom_hashes))
+                       for path in paths):
+                graph.bloom_stats["definitely_not"] += 1
+                return False
+            graph.bloom_stats["maybe"] += 1
+            maybe = True
+        else:
+            graph.bloom_stats["no_filter"] += 1
+
+    tree = commit_tree(repo, sha)
+    if not parents:
+        return next(tree_diff(repo, None, tree, paths=paths), None) is not None
+
+    for i, p in enumerate(parents):
+        # The first difference is enough: the diff stops there.
+        if next(tree_diff(repo, commit_tree(repo, p), tree, paths=paths), None) is None:
+            if i == 0 and maybe:
+                graph.bloom_stats["false_positives"] += 1
+            return False
+    return True
+
+def commit_meta(repo, sha):
+    """(parents, date, generation) of the commit SHA.  Read from the
+    commit-graph when it has SHA, otherwise by parsing the commit, in
+    which case the generation is GENERATION_INFINITY."""
+    graph = commit_graph_get(repo)
+    if graph:
+        pos = graph.find(sha)
+        if pos is not None:
+            return ([graph.sha_at(p) for p in graph.parents_at(pos)],
+                    graph.date_at(pos),
+                    graph.generation_at(pos))
 
     commit = object_read(repo, sha)
+    if commit is None or commit.fmt != b'commit':
+        raise Exception(f"Not a commit: {sha}")
+    return commit_parents(commit), commit_date(commit), GENERATION_INFINITY
+
+# Once only excluded commits are queued, rev_walk still pops this many,
+# in case clock skew hid an excluded ancestor behind them (git's SLOP).
+REV_WALK_SLOP = 5
+
+def rev_walk(repo, include, exclude=(), since=None, limit=None, paths=None):
+    """Yield the SHA of every commit reachable from INCLUDE but not from
+    EXCLUDE, newest committer date first.
+
+    Iterative: a heap ordered by date holds the frontier, so history
+    depth doesn't matter.  Without EXCLUDE, commits stream out as
+    they're found.  With it, the walk is limited first, like git's
+    limit_list: a commit can turn out excluded after it was reached
+    (dates tie, or lie), so exclusion spreads through every commit seen
+    so far and nothing is yielded until no interesting commit is left
+    queued.  With SINCE, older commits end the walk along their line of
+    history.  Parents and dates come from commit_meta, so with a
+    commit-graph no commit is inflated unless the caller reads it.  With
+    PATHS, only commits that changed one of them are yielded (see
+    commit_touches)."""
+    heap = list()
+    uninteresting = set()
+    seen = set()
+    done = set()      # Popped off the heap
+    parents_of = dict()
+    interesting = 0   # Queued commits not known to be excluded
+    counter = 0       # Ties on date are broken by discovery order.
+
+    def push(sha):
+        nonlocal counter, interesting
+        if sha in seen:
+            return
+        seen.add(sha)
+        parents, date, _ = commit_meta(repo, sha)
+        parents_of[sha] = parents
+        counter += 1
+        heapq.heappush(heap, (-date, counter, sha))
+        if sha not in uninteresting:
+            interesting += 1
+
+    def exclude_ancestors(sha):
+        # Dışlanan bir commit'in bütün ataları da dışlanır, daha önce
+        # görülmüş olsalar bile.
+        nonlocal interesting
+        stack = list(parents_of[sha])
+        while stack:
+            p = stack.pop()
+            if p in uninteresting:
+                continue
+            uninteresting.add(p)
+            if p in seen:
+                if p not in done:
+                    interesting -= 1
+                stack.extend(parents_of[p])
+
+    def pop():
+        """Pop the newest commit and queue its parents.  Returns (sha,
+        parents, date) if it may be shown, None otherwise."""
+        nonlocal interesting
+        date, _, sha = heapq.heappop(heap)
+        done.add(sha)
+        parents = parents_of[sha]
+        if sha in uninteresting:
+            exclude_ancestors(sha)
+            for p in parents:
+                push(p)
+            return None
+        interesting -= 1
+        if since is not None and -date < since:
+            return None
+        for p in parents:
+            push(p)
+        return sha, parents, -date
+
+    def stream():
+        while heap:
+            commit = pop()
+            if commit:
+                yield commit
+
+    def limited():
+        found = list()
+        slop = REV_WALK_SLOP
+        while heap and slop:
+            commit = pop()
+            if commit:
+                found.append(commit)
+            elif heap and ((found and -heap[0][0] >= found[-1][2]) or interesting):
+                # Queued commits as new as the last one found may still
+                # exclude it, like interesting ones may.
+                slop = REV_WALK_SLOP
+            else:
+                slop -= 1
+        # Some of them may have been excluded after they were popped.
+        return [c for c in found if c[0] not in uninteresting]
+
+    for sha in exclude:
+        uninteresting.add(sha)
+        push(sha)
+    for sha in include:
+        push(sha)
+
+    shown = 0
+    for sha, parents, _ in (limited() if uninteresting else stream()):
+        if paths and not commit_touches(repo, sha, parents, paths):
+            continue
+
+        yield sha
+        shown += 1
+        if limit is not None and shown >= limit:
+            return
+
+# Flags of the merge-base paint walk.
+PAINT_PARENT1 = 1 # Reachable from the first commit
+PAINT_PARENT2 = 2 # Reachable from one of the others
+PAINT_STALE = 4   # Below a common ancestor: can't be a best merge base
+PAINT_RESULT = 8
+
+def paint_down_to_common(repo, one, twos, min_generation=0):
+    """Walk down from ONE and TWOS, painting each commit with the side(s)
+    it's reachable from, and return the commits found painted by both
+    that aren't below another one, plus the paint.
+
+    Commits come off a queue highest generation first, then newest date,
+    so everything below a common ancestor is reached after it; the walk
+    ends as soon as only stale commits are queued, and never goes below
+    MIN_GENERATION."""
+    flags = dict()
+    heap = list()
+    counter = 0
+    nonstale = 0 # Queued commits not painted stale
+
+    def push(sha):
+        nonlocal counter, nonstale
+        _, date, gen = commit_meta(repo, sha)
+        counter += 1
+        heapq.heappush(heap, (-gen, -date, counter, sha, flags[sha] & PAINT_STALE))
+        if not flags[sha] & PAINT_STALE:
+            nonstale += 1
+
+    flags[one] = PAINT_PARENT1
+    push(one)
+    for two in twos:
+        flags[two] = flags.get(two, 0) | PAINT_PARENT2
+        push(two)
+
+    result = list()
+    while nonstale:
+        neg_gen, _, _, sha, was_stale = heapq.heappop(heap)
+        if not was_stale:
+            nonstale -= 1
+        if -neg_gen < min_generation:
+            break
+
+        paint = flags[sha] & (PAINT_PARENT1 | PAINT_PARENT2 | PAINT_STALE)
+        if paint == PAINT_PARENT1 | PAINT_PARENT2:
+            if not flags[sha] & PAINT_RESULT:
+                flags[sha] |= PAINT_RESULT
+                result.append(sha)
+            # Ancestors of a common ancestor are common but not best.
+            paint |= PAINT_STALE
+
+        for p in commit_meta(repo, sha)[0]:
+            if flags.get(p, 0) & paint == paint:
+                continue
+            flags[p] = flags.get(p, 0) | paint
+            push(p)
+
+    return [sha for sha in result if not flags[sha] & PAINT_STALE], flags
+
+def commit_order_key(repo, sha):
+    _, date, gen = commit_meta(repo, sha)
+    return (gen, date)
+
+def merge_bases(repo, one, twos, all=True):
+    """Best common ancestors of ONE and every commit in TWOS: common
+    ancestors that aren't ancestors of other common ancestors, newest
+    first.  With ALL false, stop at the first."""
+    if one in twos:
+        return [one]
+
+    result, _ = paint_down_to_common(repo, one, twos)
+    result.sort(key=lambda sha: commit_order_key(repo, sha), reverse=True)
+
+    # The walk can reach a common ancestor before seeing that it's below
+    # another one (clock skew, commits outside the commit-graph).
+    if len(result) > 1:
+        result = [sha for sha in result
+                  if not any(other != sha and is_ancestor(repo, sha, other) for other in result)]
+
+    return result if all else result[:1]
+
+def is_ancestor(repo, a, b):
+    """Whether commit A is B or one of its ancestors."""
+    if a == b:
+        return True
+
+    _, _, gen_a = commit_meta(repo, a)
+    _, _, gen_b = commit_meta(repo, b)
+    min_generation = 0
+    if gen_a != GENERATION_INFINITY:
+        # Generations strictly increase from parent to child, and the
+        # graph holds every ancestor of its commits.
+        if gen_b != GENERATION_INFINITY and gen_a >= gen_b:
+            return False
+        min_generation = gen_a
+    elif gen_b != GENERATION_INFINITY:
+        return False
+
+    _, flags = paint_down_to_common(repo, a, [b], min_generation)
+    return bool(flags[a] & PAINT_PARENT2)
+
+def cmd_merge_base(args):
+    repo = repo_find()
+    shas = [object_find(repo, name, fmt=b'commit') for name in args.commit]
+
+    if args.is_ancestor:
+        if len(shas) != 2:
+            raise Exception("--is-ancestor takes exactly two commits")
+        sys.exit(0 if is_ancestor(repo, shas[0], shas[1]) else 1)
+
+    if len(shas) < 2:
+        raise Exception("merge-base needs at least two commits")
+    bases = merge_bases(repo, shas[0], shas[1:], all=args.all)
+    if not bases:
+        sys.exit(1)
+    for sha in bases:
+        print(sha)
+
+def rev_parse_range(repo, names):
+    """Turn log arguments into (include, exclude) SHA lists."""
+    include = list()
+    exclude = list()
+    for name in names:
+        if ".." in name:
+            a, b = name.split("..", 1)
+            exclude.append(object_find(repo, a or "HEAD", fmt=b'commit'))
+            include.append(object_find(repo, b or "HEAD", fmt=b'commit'))
+        elif name.startswith("^"):
+            exclude.append(object_find(repo, name[1:], fmt=b'commit'))
+        else:
+            include.append(object_find(repo, name, fmt=b'commit'))
+    return include, exclude
+
+def log_paths(paths):
+    """Normalize the paths given after "--" to worktree-relative form."""
+    ret = list()
+    for path in paths:
+        path = os.path.normpath(path).strip("/")
+        if path != ".":
+            ret.append(path)
+    return ret
+
+def log_parse_since(since):
+    if since is None:
+        return None
+    if since.isdigit():
+        return int(since)
+    return int(datetime.fromisoformat(since).timestamp())
+
+# Komut satırı log fonksiyonu.
+def cmd_log(args):
+    repo = repo_find()
+    include, exclude = rev_parse_range(repo, args.commit)
+    commits = ((sha, object_read(repo, sha))
+               for sha in rev_walk(repo, include, exclude,
+                                   since=log_parse_since(args.since), limit=args.limit,
+                                   paths=log_paths(args.paths)))
+
+    match args.format:
+        case "graphviz":
+            log_graphviz(repo, commits)
+        case "text":
+            log_text(commits)
+        case "oneline":
+            length = repo_abbrev_length(repo)
+            for sha, commit in commits:
+                print(f"{object_abbrev(repo, sha, length)} {log_summary(commit)}")
+
+def log_summary(commit):
     message = commit.kvlm[None].decode("utf8").strip()
-    # Mesajı Graphviz için hazırla
-    message = message.replace("\\", "\\\\").replace("\"", "\\\"")
     if "\n" in message:
         message = message[:message.index("\n")]
+    return message
+
+def log_text(commits):
+    for sha, commit in commits:
+        print(f"commit {sha}")
+        parents = commit_parents(commit)
+        if len(parents) > 1:
+            print("Merge: " + " ".join(p[0:7] for p in parents))
+        author = commit.kvlm.get(b'author', b'').decode("utf8")
+        name, _, when = author.rpartition("> ")
+        print(f"Author: {name}>" if name else f"Author: {author}")
+        if when:
+            print(f"Date:   {datetime.fromtimestamp(commit_date(commit))}")
+        print()
+        for line in commit.kvlm[None].decode("utf8").rstrip("\n").split("\n"):
+            print(f"    {line}")
+        print()
 
-    # Commit düğümünü Graphviz çıktısına ekle
-    print(f"  c_{sha} [label=\"{sha[0:7]}: {message}\"]")
-    assert commit.fmt == b'commit'
+# Commit geçmişini Graphviz formatında görselleştirir.
+def log_graphviz(repo, commits):
+    print("digraph wyaglog{")
+    print("  node[shape=rect]")
+    length = repo_abbrev_length(repo)
 
-    # Eğer parent yoksa dur
-    if not b'parent' in commit.kvlm.keys():
-        return
+    for sha, commit in commits:
+        # Mesajı Graphviz için hazırla
+        message = log_summary(commit)
+        message = message.replace("\\", "\\\\").replace("\"", "\\\"")
 
-    parents = commit.kvlm[b'parent']
-    if type(parents) != list:
-        parents = [parents]
+        # Commit düğümünü Graphviz çıktısına ekle
+        print(f"  c_{sha} [label=\"{object_abbrev(repo, sha, length)}: {message}\"]")
+
+        # Parent'lar için ok çiz
+        for p in commit_parents(commit):
+            print(f"  c_{sha} -> c_{p};")
 
-    # Parent'lar için ok çiz ve özyinelemeli çağrı yap
-    for p in parents:
-        p = p.decode("ascii")
-        print(f"  c_{sha} -> c_{p};")
-        log_graphviz(repo, p, seen)
+    print("}")
 
 
 class GitTreeLeaf(object):
@@ -489,17 +1794,19 @@ def tree_parse(raw):
     return ret
 
 def tree_leaf_sort_key(leaf):
-    if leaf.mode.startswith(b"10"):
-        return leaf.path
-    else:
+    # Git sorts subtrees as if their name ended with a slash.
+    if leaf.mode.startswith(b"04"):
         return leaf.path + "/"
+    else:
+        return leaf.path
     
 
 def tree_serialize(obj):
     obj.items.sort(key=tree_leaf_sort_key)
     ret = b''
     for i in obj.items:
-        ret += i.mode
+        # We keep modes on 6 digits, git writes trees as 40000.
+        ret += i.mode.lstrip(b'0')
         ret += b' '
         ret += i.path.encode("utf8")
         ret += b'\x00'
@@ -545,6 +1852,96 @@ def ls_tree(repo , ref, recursive=None, prefix = ""):
             ls_tree(repo, item.sha, recursive, os.path.join(prefix, item.path))
 
 
+def path_in_scope(path, paths, is_tree=False):
+    """Whether PATH is one of PATHS or below one, or, for a directory,
+    leads to one."""
+    for p in paths:
+        if path == p or path.startswith(p + "/"):
+            return True
+        if is_tree and p.startswith(path + "/"):
+            return True
+    return False
+
+def tree_diff(repo, old, new, prefix="", recursive=True, paths=None):
+    """Yield (path, old, new) for every entry that differs between the
+    trees OLD and NEW (SHAs, or None for the empty tree).  The entries
+    yielded are (mode, sha) pairs, or None on the side that lacks the
+    path: None, x is an addition, x, None a deletion.
+
+    Both item lists are already in git's tree order, so they're merged
+    in one pass, and a subtree with the same SHA on both sides is never
+    read.  With RECURSIVE, differing subtrees are descended into and
+    only their files reported; otherwise the subtrees themselves are.
+    PATHS limits the walk to those paths and what's below them.  It's a
+    generator: stop iterating and nothing more gets read."""
+    if old == new:
+        return
+    a = object_read(repo, old).items if old else []
+    b = object_read(repo, new).items if new else []
+
+    i = j = 0
+    while i < len(a) or j < len(b):
+        ka = tree_leaf_sort_key(a[i]) if i < len(a) else None
+        kb = tree_leaf_sort_key(b[j]) if j < len(b) else None
+        # A subtree's key ends with "/", so equal keys mean both sides
+        # are trees or both aren't.
+        if kb is None or (ka is not None and ka < kb):
+            x, y = a[i], None
+            i += 1
+        elif ka is None or kb < ka:
+            x, y = None, b[j]
+            j += 1
+        else:
+            x, y = a[i], b[j]
+            i += 1
+            j += 1
+
+        if x and y and x.mode == y.mode and x.sha == y.sha:
+            continue
+
+        leaf = x or y
+        path = prefix + leaf.path
+        is_tree = leaf.mode.startswith(b'04')
+        if paths is not None and not path_in_scope(path, paths, is_tree):
+            continue
+
+        if is_tree and recursive:
+            yield from tree_diff(repo, x and x.sha, y and y.sha, path + "/", recursive, paths)
+        else:
+            yield path, x and (x.mode, x.sha), y and (y.mode, y.sha)
+
+def cmd_diff_tree(args):
+    repo = repo_find()
+    paths = log_paths(args.paths) or None
+
+    if len(args.tree) == 1:
+        sha = object_find(repo, args.tree[0], fmt=b'commit')
+        parents = commit_meta(repo, sha)[0]
+        # Like git, a merge shows nothing, a root only with --root.
+        if len(parents) > 1 or (not parents and not args.root):
+            return
+        old = commit_tree(repo, parents[0]) if parents else None
+        new = commit_tree(repo, sha)
+        print(sha)
+    elif len(args.tree) == 2:
+        old = object_find(repo, args.tree[0], fmt=b'tree')
+        new = object_find(repo, args.tree[1], fmt=b'tree')
+    else:
+        raise Exception("diff-tree takes one commit or two trees")
+
+    for path, a, b in tree_diff(repo, old, new, recursive=args.recursive, paths=paths):
+        if a is None:
+            status = "A"
+        elif b is None:
+            status = "D"
+        elif a[0][:2] != b[0][:2]:
+            status = "T" # File became symlink, or the reverse.
+        else:
+            status = "M"
+        a_mode, a_sha = a or (b"000000", ZERO_SHA)
+        b_mode, b_sha = b or (b"000000", ZERO_SHA)
+        print(f":{a_mode.decode()} {b_mode.decode()} {a_sha} {b_sha} {status}\t{path}")
+
 def cmd_checkout(args):
     repo = repo_find()
      
@@ -566,60 +1963,269 @@ def cmd_checkout(args):
 
 def tree_checkout(repo, tree, path):
     for item in tree.items:
-        obj = object_read(repo , item.sha)
         dest = os.path.join(path, item.path)
-        if obj.fmt == b'tree':
+        if item.mode.startswith(b'04'):
             os.mkdir(dest)
-            tree_checkout(repo, obj, dest)
-        elif obj.fmt == b'blob':
+            tree_checkout(repo, object_read(repo, item.sha), dest)
+        elif item.mode.startswith(b'10') or item.mode.startswith(b'12'):
+            # Copy blobs chunk by chunk so big files don't sit in memory.
+            fmt, _, chunks = object_read_stream(repo, item.sha)
+            assert fmt == b'blob'
             with open(dest, 'wb') as f:
-                f.write(obj.blobdata)
+                for chunk in chunks:
+                    f.write(chunk)
 
         
-def ref_resolve(repo, ref):
-    path = repo_file(repo, ref)
-
-    if not os.path.isfile(path):
-        return None 
+class GitRefs(object):
+    """Refs under refs/, read as they're asked for and remembered for
+    the process.  Looking up one name opens its loose file, falling back
+    to packed-refs; only listing refs (prefixed) scans refs/, once.
+    Loose refs override those in packed-refs, and the names a scan
+    finds are kept sorted so a prefix (refs/tags/, ...) is a bisect
+    away."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.loose = dict()  # name -> its loose file's value ("ref: <target>" for symbolic refs), None if it has none
+        self.packed = dict() # name -> SHA, as found in packed-refs
+        self.peeled = dict() # name -> what the annotated tag it points to points to
+        self.names = None    # Sorted names of every ref, once refs/ was scanned
+        self.lock_stats = {"locked": 0,    # Lockfiles taken
+                           "contended": 0, # Attempts that found a lockfile already there
+                           "timeouts": 0,  # Locks given up on
+                           "aborted": 0,   # Transactions rolled back
+                           "committed": 0}
+
+        self.packed_stat = self.read_packed(repo)
+
+    def read_loose(self, path):
+        try:
+            with open(path, "r") as f:
+                return f.read().strip() or None
+        except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+            return None
 
-    with open(path, 'r') as fp:
-        data = fp.read()[:-1]
+    def scan(self):
+        """Read every loose ref, and sort the names of all refs."""
+        root = repo_dir(self.repo, "refs")
+        stack = [(root, "refs/")] if root else []
+        while stack:
+            path, prefix = stack.pop()
+            with os.scandir(path) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append((entry.path, prefix + entry.name + "/"))
+                    elif not entry.name.endswith(".lock"):
+                        name = prefix + entry.name
+                        if name not in self.loose:
+                            self.loose[name] = self.read_loose(entry.path)
+
+        names = {name for name, value in self.loose.items() if value is not None}
+        names.update(self.packed)
+        self.names = sorted(names)
+
+    def read_packed(self, repo):
+        """Load packed-refs into self.packed and self.peeled, returning
+        the (mtime, size) it was read at."""
+        self.packed = dict()
+        self.peeled = dict()
+        path = repo_path(repo, "packed-refs")
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
 
-    if data.startswith("ref: "):
-        return ref_resolve(repo, data[5:])
-    else:
-        return data
-    
-def ref_list(repo, path=None):
-    if not path:
-        path = repo_dir(repo, "refs")
-    ret = dict()
+        with open(path, "r") as f:
+            last = None
+            for line in f:
+                line = line.rstrip("\n")
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith("^"):
+                    if last:
+                        self.peeled[last] = line[1:]
+                    continue
+                sha, last = line.split(" ", 1)
+                self.packed[last] = sha
+        return (st.st_mtime_ns, st.st_size)
+
+    def refresh_packed(self, repo):
+        """Reload packed-refs if another process rewrote it."""
+        try:
+            st = os.stat(repo_path(repo, "packed-refs"))
+            current = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            current = None
+        if current == self.packed_stat:
+            return
+
+        old = self.packed
+        self.packed_stat = self.read_packed(repo)
+        if self.names is None:
+            return
+        for name in old:
+            if name not in self.packed and self.loose.get(name) is None:
+                del self.names[bisect_left(self.names, name)]
+        for name in self.packed:
+            if name not in old and self.loose.get(name) is None:
+                insort(self.names, name)
+
+    def report(self):
+        print("ref locks: " + ", ".join(f"{k}={v}" for k, v in self.lock_stats.items()),
+              file=sys.stderr)
+
+    def get(self, name):
+        # After a scan, a name it didn't see has no loose file.
+        if name not in self.loose and self.names is None:
+            self.loose[name] = self.read_loose(repo_path(self.repo, name))
+        value = self.loose.get(name)
+        return value if value is not None else self.packed.get(name)
+
+    def set(self, name, value):
+        if self.names is not None and self.loose.get(name) is None and name not in self.packed:
+            insort(self.names, name)
+        self.loose[name] = value
+        self.peeled.pop(name, None)
+
+    def delete(self, name):
+        if self.names is not None and (self.loose.get(name) is not None or name in self.packed):
+            del self.names[bisect_left(self.names, name)]
+        self.loose[name] = None
+        self.packed.pop(name, None)
+        self.peeled.pop(name, None)
+
+    def prefixed(self, prefix):
+        """Sorted names starting with PREFIX."""
+        if self.names is None:
+            self.scan()
+        lo = bisect_left(self.names, prefix)
+        hi = lo
+        while hi < len(self.names) and self.names[hi].startswith(prefix):
+            hi += 1
+        return self.names[lo:hi]
+
+def ref_cache_get(repo):
+    if repo.refs is None:
+        repo.refs = GitRefs(repo)
+        if os.environ.get("WYAG_REF_STATS"):
+            atexit.register(repo.refs.report)
+    return repo.refs
+
+# Symbolic refs pointing at symbolic refs more than this deep are a loop.
+REF_MAX_DEPTH = 5
 
-    for f in sorted(os.listdir(path)):
-        can = os.path.join(path,f)
-        if os.path.isdir(can):
-            ret[f] = ref_list(repo, can)
+def ref_resolve(repo, ref):
+    """The SHA REF points to, following symbolic refs, or None.  Refs
+    under refs/ come from the ref cache, others (HEAD, ...) are read
+    from their file."""
+    for _ in range(REF_MAX_DEPTH + 1):
+        if ref.startswith("refs/"):
+            data = ref_cache_get(repo).get(ref)
         else:
-            ret[f] = ref_resolve(repo, can)
+            path = repo_file(repo, ref)
+            if not os.path.isfile(path):
+                return None
+            with open(path, 'r') as fp:
+                data = fp.read().strip()
+
+        if data is None:
+            return None
+        if not data.startswith("ref: "):
+            return data
+        ref = data[5:]
+    raise Exception(f"Too many levels of symbolic refs at {ref}")
+
+def ref_list(repo, prefix="refs/"):
+    """Refs under PREFIX as a nested dict, one level per path component,
+    with the SHAs they resolve to as leaves."""
+    ret = dict()
+    for name in ref_cache_get(repo).prefixed(prefix):
+        parts = name[len(prefix):].split("/")
+        d = ret
+        for part in parts[:-1]:
+            d = d.setdefault(part, dict())
+        d[parts[-1]] = ref_resolve(repo, name)
     return ret
 
 def cmd_show_ref(args):
     repo = repo_find()
-    refs = ref_list()
-    show_ref(repo, refs,prefix = "refs")
+    for name in ref_cache_get(repo).prefixed("refs/"):
+        sha = ref_resolve(repo, name)
+        if sha:
+            print(f"{sha} {name}")
 
 def show_ref(repo, refs,with_hash=True, prefix=""):
     if prefix:
         prefix = prefix + "/"
     
-    for k, v in refs.item():
+    for k, v in refs.items():
         if type(v) == str and with_hash:
-            print(f"{v} {prefix} {k}")
+            print(f"{v} {prefix}{k}")
         elif type(v) == str:
             print(f"{prefix}{k}")
         else:
             show_ref(repo , v ,with_hash=with_hash,prefix=f"{prefix}{k}")
 
+def cmd_pack_refs(args):
+    repo = repo_find()
+    pack_refs(repo, all=args.all, prune=args.prune)
+
+def pack_refs(repo, all=False, prune=True):
+    """Write tags (with ALL, every ref) and whatever was already packed
+    to packed-refs, with peeled values for annotated tags.  With PRUNE,
+    delete the loose files of the refs packed."""
+    refs = ref_cache_get(repo)
+
+    packed = dict(refs.packed)
+    for name in refs.prefixed("refs/"):
+        value = refs.get(name)
+        if value.startswith("ref: "):
+            continue # Symbolic refs can't be packed.
+        if all or name.startswith("refs/tags/") or name in refs.packed:
+            packed[name] = value
+
+    peeled = dict()
+    for name, sha in packed.items():
+        obj = object_read(repo, sha)
+        while obj is not None and obj.fmt == b'tag':
+            peeled[name] = obj.kvlm[b'object'].decode("ascii")
+            obj = object_read(repo, peeled[name])
+
+    refs.packed = packed
+    refs.peeled = peeled
+    lockfile_write(repo_path(repo, "packed-refs"), ref_packed_serialize(refs),
+                   fsync=repo_fsync(repo, "reference"))
+    refs.packed_stat = None
+
+    if prune:
+        refs_dir = repo_dir(repo, "refs")
+        timeout = repo.conf.getint("core", "filesreflocktimeout", fallback=REF_LOCK_TIMEOUT) / 1000
+        for name in sorted(packed):
+            if refs.loose.get(name) is None:
+                continue
+            path = repo_path(repo, name)
+            # Under the ref's lock, so an update can't land between the
+            # check and the unlink.
+            try:
+                os.close(lockfile_open(path, timeout, refs.lock_stats))
+            except Exception:
+                continue # Being updated: keep the loose ref.
+            try:
+                if refs.read_loose(path) != packed[name]:
+                    continue # Changed under us: the loose one wins.
+                os.unlink(path)
+                refs.loose[name] = None
+            finally:
+                os.unlink(path + ".lock")
+            # Drop directories emptied, but keep refs/heads, refs/tags...
+            d = os.path.dirname(path)
+            while d != refs_dir and os.path.dirname(d) != refs_dir:
+                try:
+                    os.rmdir(d)
+                except OSError:
+                    break
+                d = os.path.dirname(d)
+
 
 class GitTag(GitCommit):
     fmt = b'tag'
@@ -629,8 +2235,8 @@ def cmd_tag(args):
     if args.name :
         tag_create(repo,args.name,args.object,create_tag_object= args.create_tag_object)
     else:
-        refs= ref_list(repo)
-        show_ref(repo,refs["tags"], with_hash=False)
+        refs= ref_list(repo, "refs/tags/")
+        show_ref(repo,refs, with_hash=False)
 
 def tag_create(repo, name,ref,create_tag_object=False):
 
@@ -649,20 +2255,262 @@ def tag_create(repo, name,ref,create_tag_object=False):
 
         tag_sha = object_write(tag,repo)
 
-        ref_create(repo, "tags/" +name ,sha)
+        ref_create(repo, "tags/" +name ,tag_sha, old=ZERO_SHA, message="tag: tagging")
 
     else:
-        ref_create(repo, "tags/"+name,sha)
+        ref_create(repo, "tags/"+name,sha, old=ZERO_SHA, message="tag: tagging")
+
+def ref_create(repo,ref_name,sha,old=None,message=""):
+    """Point refs/REF_NAME at SHA.  OLD is as in GitRefTransaction.update."""
+    tx = GitRefTransaction(repo)
+    tx.update("refs/"+ref_name, sha, old=old, message=message)
+    tx.commit()
+
+# The "no object" SHA: as an old value, the ref must not exist yet.
+ZERO_SHA = "0" * 40
+
+# How long to wait for a ref lock held by another process, in
+# milliseconds, unless core.filesRefLockTimeout says otherwise.
+REF_LOCK_TIMEOUT = 100
+
+class GitRefTransaction(object):
+    """A set of ref updates applied all-or-nothing.
+
+    commit() locks every ref (<ref>.lock, in name order so concurrent
+    transactions can't deadlock), checks each expected old value against
+    what's on disk, writes the new values into the lockfiles, and only
+    then renames them all into place and appends to the reflogs.  Any
+    failure before the renames removes every lock and changes nothing."""
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.updates = list() # [name, new, old, message]
+
+    def update(self, name, new, old=None, message=""):
+        """Set NAME to NEW (a SHA, or None to delete it).  OLD is the
+        value NAME must have now: None to skip the check, ZERO_SHA if it
+        must not exist.  Symbolic refs (HEAD) are followed, and both
+        reflogs updated."""
+        self.updates.append([name, new, old, message])
+
+    def delete(self, name, old=None, message=""):
+        self.update(name, None, old=old, message=message)
+
+    def commit(self):
+        repo = self.repo
+        refs = ref_cache_get(repo)
+        fsync = repo_fsync(repo, "reference")
+        timeout = repo.conf.getint("core", "filesreflocktimeout", fallback=REF_LOCK_TIMEOUT) / 1000
+
+        # Who gets which update: symbolic refs pass it on to their target.
+        updates = list()
+        via = dict() # target -> symbolic refs that led to it, for their reflogs
+        for name, new, old, message in self.updates:
+            target, symrefs = ref_follow(repo, name)
+            if any(u[0] == target for u in updates):
+                raise Exception(f"Multiple updates for ref {target} not allowed")
+            updates.append((target, new, old, message))
+            via[target] = symrefs
+        updates.sort()
+
+        locks = list() # [path, fd], fd set to None once closed
+        packed_lock = None
+        try:
+            for name, new, old, message in updates:
+                path = repo_path(repo, name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                locks.append([path, lockfile_open(path, timeout, refs.lock_stats)])
+
+            # Deleting a packed ref means rewriting packed-refs, under its lock.
+            refs.refresh_packed(repo)
+            if any(new is None and name in refs.packed for name, new, _, _ in updates):
+                packed_path = repo_path(repo, "packed-refs")
+                packed_lock = [packed_path, lockfile_open(packed_path, timeout, refs.lock_stats)]
+                refs.refresh_packed(repo)
+
+            current = dict()
+            for (name, new, old, _), lock in zip(updates, locks):
+                path, fd = lock
+                current[name] = ref_read_locked(refs, name, path)
+                if old is not None and (current[name] or ZERO_SHA) != old:
+                    raise Exception(f"Cannot lock ref {name}: is at {current[name] or 'nothing'} but expected {old}")
+                if new is not None:
+                    os.write(fd, (new + "\n").encode())
+                    if fsync:
+                        os.fsync(fd)
+                lock[1] = None
+                os.close(fd)
+
+            if packed_lock:
+                deleted = {name for name, new, _, _ in updates if new is None}
+                data = ref_packed_serialize(refs, deleted)
+                os.write(packed_lock[1], data)
+                if fsync:
+                    os.fsync(packed_lock[1])
+                fd, packed_lock[1] = packed_lock[1], None
+                os.close(fd)
+        except BaseException:
+            for path, fd in locks + ([packed_lock] if packed_lock else []):
+                if fd is not None:
+                    os.close(fd)
+                os.unlink(path + ".lock")
+            refs.lock_stats["aborted"] += 1
+            raise
+
+        # Point of no return.  Reflogs are appended while the locks are
+        # still held, so their entries are in the order the refs moved.
+        for name, new, old, message in updates:
+            if new is None:
+                # Like git, a deleted ref takes its reflog with it.
+                log = repo_path(repo, "logs", name)
+                if os.path.exists(log):
+                    os.unlink(log)
+            else:
+                for log in [name] + via[name]:
+                    reflog_append(repo, log, current[name] or ZERO_SHA, new, message)
+
+        for (name, new, old, message), (path, _) in zip(updates, locks):
+            if new is None:
+                if os.path.exists(path):
+                    os.unlink(path)
+                os.unlink(path + ".lock")
+                refs.delete(name)
+            else:
+                os.replace(path + ".lock", path)
+                if name.startswith("refs/"):
+                    refs.set(name, new)
+        if packed_lock:
+            os.replace(packed_lock[0] + ".lock", packed_lock[0])
+            refs.packed_stat = None
 
-def ref_create(repo,ref_name,sha):
-    with open(repo_file(repo, "refs/"+ref_name,'w')) as fp:
-        fp.write(sha+ "\n")
+        refs.lock_stats["committed"] += 1
 
+def cmd_update_ref(args):
+    repo = repo_find()
+    tx = GitRefTransaction(repo)
+
+    def value(name):
+        return name if name == ZERO_SHA else object_find(repo, name)
+
+    def old_value(name):
+        # Like git, an OLD that's a full SHA is compared as given, even
+        # if the object is missing.  Only names get resolved.
+        if len(name) == 40 and HASH_RE.match(name):
+            return name.lower()
+        return value(name)
+
+    if args.stdin:
+        # One "update REF NEW [OLD]", "create REF NEW" or "delete REF [OLD]"
+        # per line, all applied in one transaction.
+        for line in sys.stdin:
+            words = line.split()
+            if not words:
+                continue
+            match words:
+                case ["update", ref, new]:
+                    tx.update(ref, value(new), message=args.message)
+                case ["update", ref, new, old]:
+                    tx.update(ref, value(new), old=old_value(old), message=args.message)
+                case ["create", ref, new]:
+                    tx.update(ref, value(new), old=ZERO_SHA, message=args.message)
+                case ["delete", ref]:
+                    tx.delete(ref, message=args.message)
+                case ["delete", ref, old]:
+                    tx.delete(ref, old=old_value(old), message=args.message)
+                case _:
+                    raise Exception(f"Bad update-ref command: {line.strip()}")
+    elif args.delete:
+        if not args.ref or args.old:
+            raise Exception("usage: wyag update-ref -d REF [OLD]")
+        tx.delete(args.ref, old=old_value(args.new) if args.new else None, message=args.message)
+    else:
+        if not args.ref or not args.new:
+            raise Exception("usage: wyag update-ref REF NEW [OLD]")
+        tx.update(args.ref, value(args.new), old=old_value(args.old) if args.old else None,
+                  message=args.message)
+
+    tx.commit()
+
+def ref_follow(repo, name):
+    """The ref NAME ends up at after following symbolic refs, and the
+    symbolic refs passed through."""
+    symrefs = list()
+    for _ in range(REF_MAX_DEPTH + 1):
+        if name.startswith("refs/"):
+            data = ref_cache_get(repo).get(name)
+        else:
+            path = repo_path(repo, name)
+            data = None
+            if os.path.isfile(path):
+                with open(path, "r") as f:
+                    data = f.read().strip()
+        if not data or not data.startswith("ref: "):
+            return name, symrefs
+        symrefs.append(name)
+        name = data[5:]
+    raise Exception(f"Too many levels of symbolic refs at {name}")
+
+def ref_read_locked(refs, name, path):
+    """Current value of ref NAME at PATH, read from disk (we hold its
+    lock), then from packed-refs."""
+    try:
+        with open(path, "r") as f:
+            value = f.read().strip()
+        if value:
+            return value
+    except FileNotFoundError:
+        pass
+    return refs.packed.get(name)
+
+def ref_packed_serialize(refs, deleted=()):
+    """packed-refs contents for REFS.packed, minus DELETED."""
+    data = ["# pack-refs with: peeled fully-peeled sorted \n"]
+    for name in sorted(refs.packed):
+        if name in deleted:
+            continue
+        data.append(f"{refs.packed[name]} {name}\n")
+        if name in refs.peeled:
+            data.append(f"^{refs.peeled[name]}\n")
+    return "".join(data).encode()
+
+def reflog_enabled(repo, name):
+    """Whether updates to ref NAME are logged: like git's
+    core.logAllRefUpdates, true by default for HEAD, branches, remote
+    branches and notes, "always" for every ref."""
+    setting = repo.conf.get("core", "logallrefupdates", fallback="true").strip().lower()
+    if setting == "always":
+        return True
+    if os.path.exists(repo_path(repo, "logs", name)):
+        return True
+    if setting in ("false", "no", "off", "0"):
+        return False
+    return name == "HEAD" or name.startswith(("refs/heads/", "refs/remotes/", "refs/notes/"))
+
+def reflog_append(repo, name, old, new, message):
+    if not reflog_enabled(repo, name):
+        return
+    who = gitconfig_user_get(gitconfig_read()) or "wyag <wyag@example.com>"
+    now = datetime.now().astimezone()
+    offset = int(now.utcoffset().total_seconds())
+    tz = "{}{:02}{:02}".format("+" if offset >= 0 else "-", abs(offset) // 3600, abs(offset) % 3600 // 60)
+    message = message.replace("\n", " ").strip()
+    line = f"{old} {new} {who} {int(now.timestamp())} {tz}\t{message}\n"
+
+    path = repo_path(repo, "logs", name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "a") as f:
+        f.write(line)
+        if repo_fsync(repo, "reference"):
+            f.flush()
+            os.fsync(f.fileno())
+
+
+# A full or abbreviated object SHA.
+HASH_RE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
 
 def object_resolve(repo, name):
 
     candidates = list()
-    hashRE = re.compile(r"^[0-9A-Fa-f]{4,40}$")
 
     if not name.strip():
         return None
@@ -670,15 +2518,13 @@ def object_resolve(repo, name):
     if name == "HEAD":
         return [ ref_resolve(repo, "HEAD") ]
 
-    if hashRE.match(name):
+    if HASH_RE.match(name):
         name = name.lower()
-        prefix = name[0:2]
-        path = repo_dir(repo, "objects", prefix, mkdir=False)
-        if path:
-            rem = name[2:]
-            for f in os.listdir(path):
-                if f.startswith(rem):
-                    candidates.append(prefix + f)
+        if len(name) == 40 and object_exists(repo, name):
+            # A full SHA needs no index.
+            candidates.append(name)
+        else:
+            candidates.extend(sha_index_get(repo).find_prefix(name))
 
     as_tag = ref_resolve(repo, "refs/tags/" + name)
     if as_tag: # 
@@ -707,12 +2553,17 @@ def object_find(repo, name, fmt=None, follow=True):
     if not fmt:
         return sha
     while True:
-        obj = object_read(repo, sha)
-      
-        if obj.fmt == fmt:
+        # Only the header is needed to know the type, don't inflate
+        # what may be a huge blob.
+        type = object_read_type(repo, sha)
+        if type is None:
+            raise Exception(f"No such object {sha}.")
+        if type == fmt:
             return sha
         if not follow:
             return None
+
+        obj = object_read(repo, sha)
         if obj.fmt == b'tag':
             sha = obj.kvlm[b'object'].decode("ascii")
         elif obj.fmt == b'commit' and fmt == b'tree':
@@ -727,9 +2578,19 @@ def cmd_rev_parse(args):
     else:
         fmt = None
 
+    # "--short NAME" hands NAME to --short; only "--short=N" sets a length.
+    short = args.short
+    if short is not None and args.name is None:
+        args.name, short = short, ""
+    if args.name is None:
+        raise Exception("rev-parse needs a name")
+
     repo = repo_find()
 
-    print(object_find(repo, args.name,fmt,follow=True))
+    sha = object_find(repo, args.name,fmt,follow=True)
+    if short is not None:
+        sha = object_abbrev(repo, sha, int(short) if short else None)
+    print(sha)
 
 
 
@@ -738,7 +2599,8 @@ class GitIndexEntry (object):
     def __init__(self, ctime=None, mtime=None, dev=None, ino=None,
                  mode_type=None, mode_perms=None, uid=None, gid=None,
                  fsize=None, sha=None, flag_assume_valid=None,
-                 flag_stage=None, name=None):
+                 flag_stage=None, name=None, raw_name=None,
+                 flag_skip_worktree=False, flag_intent_to_add=False):
         # The last time a file's metadata changed.  This is a pair
         # (timestamp in seconds, nanoseconds)
         self.ctime = ctime
@@ -764,13 +2626,33 @@ class GitIndexEntry (object):
         self.sha = sha
         self.flag_assume_valid = flag_assume_valid
         self.flag_stage = flag_stage
-        # Name of the object (full path this time!)
-        self.name = name
+        # Extended flags, only stored by index versions 3 and up.
+        self.flag_skip_worktree = flag_skip_worktree
+        self.flag_intent_to_add = flag_intent_to_add
+        # Name of the object (full path this time!).  index_read only
+        # keeps the raw bytes, they're decoded on first access.
+        self._name = name
+        self.raw_name = raw_name
+
+    @property
+    def name(self):
+        if self._name is None and self.raw_name is not None:
+            self._name = self.raw_name.decode("utf8")
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = value
+        self.raw_name = None
 
 
 class GitIndex(object):
     version = None
     entries = []
+    mtime_ns = None # When the index file was last written, None if never.
+    cache_tree = None # GitCacheTree, from the TREE extension.
+    checksum = None # The file's last 20 bytes (its SHA-1 trailer) when read.
+    lock = None # Fd of index.lock, while index_read_locked holds it.
 
     def __init__(self,version=2,entries=None):
         if not entries:
@@ -778,100 +2660,170 @@ class GitIndex(object):
         self.version=version
         self.entries=entries
 
+# Git keeps index entries sorted by name, then stage.  Python orders
+# str by code point, which is the same as UTF-8 byte order.
+def index_entry_key(entry):
+    return (entry.name, entry.flag_stage)
+
+def index_find(index, name):
+    """Position of the first entry named NAME, or None."""
+    i = bisect_left(index.entries, name, key=lambda e: e.name)
+    if i < len(index.entries) and index.entries[i].name == name:
+        return i
+    return None
+
+def index_insert(index, entry):
+    """Add ENTRY, replacing entries of the same name at any stage."""
+    lo = bisect_left(index.entries, entry.name, key=lambda e: e.name)
+    hi = bisect_right(index.entries, entry.name, lo=lo, key=lambda e: e.name)
+    index.entries[lo:hi] = [entry]
+    cache_tree_invalidate(index, entry.name)
+
+def index_remove(index, name):
+    """Drop every entry named NAME, return whether there was one."""
+    lo = bisect_left(index.entries, name, key=lambda e: e.name)
+    hi = bisect_right(index.entries, name, lo=lo, key=lambda e: e.name)
+    if lo == hi:
+        return False
+    del index.entries[lo:hi]
+    cache_tree_invalidate(index, name)
+    return True
+
+def index_entry_stat_fields(stat):
+    """The stat data an index entry stores, truncated to 32 bits like git."""
+    mask = 0xFFFFFFFF
+    return dict(ctime=((stat.st_ctime_ns // 10**9) & mask, stat.st_ctime_ns % 10**9),
+                mtime=((stat.st_mtime_ns // 10**9) & mask, stat.st_mtime_ns % 10**9),
+                dev=stat.st_dev & mask,
+                ino=stat.st_ino & mask,
+                uid=stat.st_uid & mask,
+                gid=stat.st_gid & mask,
+                fsize=stat.st_size & mask)
+
+def index_entry_from_stat(name, sha, stat):
+    """An index entry for NAME from its lstat data: a symlink gets mode
+    120000, anything else is a regular file."""
+    if S_ISLNK(stat.st_mode):
+        mode_type, mode_perms = 0b1010, 0
+    else:
+        mode_type, mode_perms = 0b1000, 0o644
+    return GitIndexEntry(mode_type=mode_type, mode_perms=mode_perms, sha=sha,
+                         flag_assume_valid=False, flag_stage=False, name=name,
+                         **index_entry_stat_fields(stat))
+
+def index_entry_refresh(entry, stat):
+    for k, v in index_entry_stat_fields(stat).items():
+        setattr(entry, k, v)
+
+def index_entry_stat_matches(entry, stat):
+    """Whether STAT is exactly what ENTRY recorded, i.e. the file can be
+    assumed unchanged without hashing it (unless the entry is racy)."""
+    for k, v in index_entry_stat_fields(stat).items():
+        if getattr(entry, k) != v:
+            return False
+    return True
+
+def index_entry_is_racy(index, entry):
+    """An entry is racy when its file was modified no earlier than the
+    index was written: a later change in the same timestamp tick would
+    leave the stat data identical, so only hashing can tell."""
+    if index.mtime_ns is None:
+        return True
+    return entry.mtime[0] * 10**9 + entry.mtime[1] >= index.mtime_ns
+
+def index_smudge_racy(index, now_ns):
+    """Before writing INDEX at NOW_NS, zero the size of entries whose
+    file was modified in the same second or later, like git's
+    ce_smudge_racily_clean_entry.  Once written, the index is newer than
+    them and they'd pass for clean even if their file changed again in
+    that second without changing size; a zero size never matches, so
+    the next status hashes them."""
+    now = (now_ns // 10**9) & 0xFFFFFFFF
+    for entry in index.entries:
+        if entry.mode_type != 0b1110 and entry.mtime[0] >= now:
+            entry.fsize = 0
+
+# Fixed-size head of an index entry, 62 bytes.
+INDEX_ENTRY = struct.Struct(">LLLLLLLLLL20sH")
+
 #Why it's so complicated
 def index_read(repo):
     index_file = repo_file(repo, "index")
 
     # New repositories have no index!
     if not os.path.exists(index_file):
-        return GitIndex()
+        return GitIndex(version=repo.conf.getint("index", "version", fallback=2))
 
     with open(index_file, 'rb') as f:
         raw = f.read()
+        index_mtime_ns = os.fstat(f.fileno()).st_mtime_ns
 
     header = raw[:12]
     signature = header[:4]
     assert signature == b"DIRC" # Stands for "DirCache"
     version = int.from_bytes(header[4:8], "big")
-    assert version == 2, "wyag only supports index file version 2"
+    assert version in [2, 3, 4], f"Unsupported index file version {version}"
     count = int.from_bytes(header[8:12], "big")
 
     entries = list()
 
-    content = raw[12:]
-    idx = 0
+    # The fixed part of every entry is decoded in one unpack: ctime and
+    # mtime (seconds, nanoseconds), dev, ino, mode (16 zero bits then
+    # the real mode), uid, gid, size, SHA and flags.
+    unpack = INDEX_ENTRY.unpack_from
+    entry_size = INDEX_ENTRY.size
+    idx = 12
+    prev_name = b''
     for i in range(0, count):
-        # Read creation time, as a unix timestamp (seconds since
-        # 1970-01-01 00:00:00, the "epoch")
-        ctime_s =  int.from_bytes(content[idx: idx+4], "big")
-        # Read creation time, as nanoseconds after that timestamps,
-        # for extra precision.
-        ctime_ns = int.from_bytes(content[idx+4: idx+8], "big")
-        # Same for modification time: first seconds from epoch.
-        mtime_s = int.from_bytes(content[idx+8: idx+12], "big")
-        # Then extra nanoseconds
-        mtime_ns = int.from_bytes(content[idx+12: idx+16], "big")
-        # Device ID
-        dev = int.from_bytes(content[idx+16: idx+20], "big")
-        # Inode
-        ino = int.from_bytes(content[idx+20: idx+24], "big")
-        # Ignored.
-        unused = int.from_bytes(content[idx+24: idx+26], "big")
-        assert 0 == unused
-        mode = int.from_bytes(content[idx+26: idx+28], "big")
+        (ctime_s, ctime_ns, mtime_s, mtime_ns, dev, ino, mode,
+         uid, gid, fsize, sha, flags) = unpack(raw, idx)
+
+        assert mode >> 16 == 0
         mode_type = mode >> 12
         assert mode_type in [0b1000, 0b1010, 0b1110]
         mode_perms = mode & 0b0000000111111111
-        # User ID
-        uid = int.from_bytes(content[idx+28: idx+32], "big")
-        # Group ID
-        gid = int.from_bytes(content[idx+32: idx+36], "big")
-        # Size
-        fsize = int.from_bytes(content[idx+36: idx+40], "big")
-        # SHA (object ID).  We'll store it as a lowercase hex string
-        # for consistency.
-        sha = format(int.from_bytes(content[idx+40: idx+60], "big"), "040x")
-        # Flags we're going to ignore
-        flags = int.from_bytes(content[idx+60: idx+62], "big")
-        # Parse flags
+
         flag_assume_valid = (flags & 0b1000000000000000) != 0
         flag_extended = (flags & 0b0100000000000000) != 0
-        assert not flag_extended
+        assert version >= 3 or not flag_extended
         flag_stage =  flags & 0b0011000000000000
         # Length of the name.  This is stored on 12 bits, some max
         # value is 0xFFF, 4095.  Since names can occasionally go
         # beyond that length, git treats 0xFFF as meaning at least
         # 0xFFF, and looks for the final 0x00 to find the end of the
-        # name --- at a small, and probably very rare, performance
-        # cost.
+        # name.
         name_length = flags & 0b0000111111111111
 
-        # We've read 62 bytes so far.
-        idx += 62
-
-        if name_length < 0xFFF:
-            assert content[idx + name_length] == 0x00
-            raw_name = content[idx:idx+name_length]
-            idx += name_length + 1
-        else:
-            print(f"Notice: Name is 0x{name_length:X} bytes long.")
-            # This probably wasn't tested enough.  It works with a
-            # path of exactly 0xFFF bytes.  Any extra bytes broke
-            # something between git, my shell and my filesystem.
-            null_idx = content.find(b'\x00', idx + 0xFFF)
-            raw_name = content[idx: null_idx]
+        idx += entry_size
+
+        flag_skip_worktree = flag_intent_to_add = False
+        if flag_extended:
+            extended = int.from_bytes(raw[idx:idx+2], "big")
+            flag_skip_worktree = (extended & 0b0100000000000000) != 0
+            flag_intent_to_add = (extended & 0b0010000000000000) != 0
+            idx += 2
+
+        if version == 4:
+            # Names are prefix-compressed: how many bytes to drop from
+            # the end of the previous name, then what to append to it.
+            # There's no padding.
+            strip, idx = offset_varint_read(raw, idx)
+            null_idx = raw.index(b'\x00', idx)
+            raw_name = prev_name[:len(prev_name) - strip] + raw[idx:null_idx]
             idx = null_idx + 1
+        else:
+            if name_length < 0xFFF:
+                assert raw[idx + name_length] == 0x00
+                null_idx = idx + name_length
+            else:
+                null_idx = raw.find(b'\x00', idx + 0xFFF)
+            raw_name = raw[idx:null_idx]
 
-        # Just parse the name as utf8.
-        name = raw_name.decode("utf8")
-
-        # Data is padded on multiples of eight bytes for pointer
-        # alignment, so we skip as many bytes as we need for the next
-        # read to start at the right position.
-
-        idx = 8 * ceil(idx / 8)
+            # Data is padded on multiples of eight bytes for pointer
+            # alignment, counted from the start of the entry.
+            idx = 12 + 8 * ceil((null_idx + 1 - 12) / 8)
+        prev_name = raw_name
 
-        # And we add this entry to our list.
         entries.append(GitIndexEntry(ctime=(ctime_s, ctime_ns),
                                      mtime=(mtime_s,  mtime_ns),
                                      dev=dev,
@@ -881,12 +2833,129 @@ def index_read(repo):
                                      uid=uid,
                                      gid=gid,
                                      fsize=fsize,
-                                     sha=sha,
+                                     sha=sha.hex(),
                                      flag_assume_valid=flag_assume_valid,
                                      flag_stage=flag_stage,
-                                     name=name))
+                                     flag_skip_worktree=flag_skip_worktree,
+                                     flag_intent_to_add=flag_intent_to_add,
+                                     raw_name=raw_name))
+
+    # Older wyag appended entries in no particular order.  Check on the
+    # raw bytes, so names stay undecoded: UTF-8 sorts like the code
+    # points index_entry_key compares.
+    if any((entries[i].raw_name, entries[i].flag_stage) > (entries[i+1].raw_name, entries[i+1].flag_stage)
+           for i in range(len(entries) - 1)):
+        entries.sort(key=index_entry_key)
+
+    index = GitIndex(version=version, entries=entries)
+    index.mtime_ns = index_mtime_ns
+    index.checksum = raw[-20:]
+
+    # Older wyag wrote neither extensions nor the trailing checksum.
+    if idx == len(raw):
+        return index
+
+    if hashlib.sha1(raw[:-20]).digest() != raw[-20:]:
+        raise Exception("Index file corrupt: bad checksum")
+
+    # Extensions: a 4 byte signature, a 4 byte size, then the data.
+    end = len(raw) - 20
+    while idx < end:
+        signature = raw[idx:idx+4]
+        size = int.from_bytes(raw[idx+4:idx+8], "big")
+        data = raw[idx+8:idx+8+size]
+        idx += 8 + size
+
+        match signature:
+            case b"TREE":
+                index.cache_tree = cache_tree_parse(data)
+            case _:
+                # Extensions starting with an uppercase letter are
+                # optional, anything else we can't ignore.
+                if not 0x41 <= signature[0] <= 0x5A:
+                    raise Exception(f"Unsupported index extension {signature}")
+
+    return index
+
+class GitCacheTree(object):
+    """A directory in the index's cache-tree, git's TREE extension: how
+    many index entries live under it, and the SHA of the tree they make.
+    A node is invalid, with entry_count -1 and no SHA, when something
+    under it changed since the tree was last written."""
+
+    def __init__(self, name="", entry_count=-1, sha=None):
+        self.name = name
+        self.entry_count = entry_count
+        self.sha = sha
+        self.children = dict()
+
+def cache_tree_parse(data):
+    # Nodes come depth first: name, NUL, "<entry count> <subtree
+    # count>\n", then the binary SHA unless the node is invalid.
+    def node(idx):
+        end = data.index(b'\x00', idx)
+        name = data[idx:end].decode("utf8")
+        nl = data.index(b'\n', end)
+        entry_count, subtrees = (int(x) for x in data[end+1:nl].split(b' '))
+        idx = nl + 1
+        sha = None
+        if entry_count >= 0:
+            sha = data[idx:idx+20].hex()
+            idx += 20
+        ret = GitCacheTree(name, entry_count, sha)
+        for _ in range(subtrees):
+            idx, child = node(idx)
+            ret.children[child.name] = child
+        return idx, ret
+
+    return node(0)[1]
+
+def cache_tree_serialize(tree):
+    ret = bytearray()
+
+    def node(n):
+        ret.extend(n.name.encode("utf8") + b'\x00')
+        ret.extend(f"{n.entry_count} {len(n.children)}\n".encode("ascii"))
+        if n.entry_count >= 0:
+            ret.extend(bytes.fromhex(n.sha))
+        # Git keeps subtrees ordered by name length, then name.
+        for child in sorted(n.children.values(), key=lambda c: (len(c.name.encode("utf8")), c.name)):
+            node(child)
+
+    node(tree)
+    return bytes(ret)
+
+def cache_tree_find(tree, path):
+    """The cache-tree node for directory PATH, or None."""
+    if tree is None or path == "":
+        return tree
+    for part in path.split("/"):
+        tree = tree.children.get(part)
+        if tree is None:
+            return None
+    return tree
 
-    return GitIndex(version=version, entries=entries)
+def cache_tree_invalidate(index, path):
+    """Invalidate every directory from the root down to the one holding
+    PATH, since the trees they make are about to change."""
+    node = index.cache_tree
+    if node is None:
+        return
+    node.entry_count, node.sha = -1, None
+    dirname = os.path.dirname(path)
+    if dirname:
+        for part in dirname.split("/"):
+            node = node.children.get(part)
+            if node is None:
+                return
+            node.entry_count, node.sha = -1, None
+
+def index_extensions(index):
+    """The (signature, data) pairs index_write appends after the entries."""
+    ret = list()
+    if index.cache_tree is not None:
+        ret.append((b"TREE", cache_tree_serialize(index.cache_tree)))
+    return ret
 
 def cmd_ls_files(args):
     repo = repo_find()
@@ -906,13 +2975,14 @@ def cmd_ls_files(args):
             print(f"  created: {datetime.fromtimestamp(e.ctime[0])}.{e.ctime[1]}, modified: {datetime.fromtimestamp(e.mtime[0])}.{e.mtime[1]}")
             print(f"  device: {e.dev}, inode: {e.ino}")
             print(f"  user: {pwd.getpwuid(e.uid).pw_name} ({e.uid})  group: {grp.getgrgid(e.gid).gr_name} ({e.gid})")
-            print(f"  flags: stage={e.flag_stage} assume_valid={e.flag_assume_valid}")
+            print(f"  flags: stage={e.flag_stage} assume_valid={e.flag_assume_valid}"
+                  f" skip_worktree={e.flag_skip_worktree} intent_to_add={e.flag_intent_to_add}")
 
 def cmd_check_ignore(args):
     repo = repo_find()
     rules = gitignore_read(repo)
     for path in args.path:
-        if check_ignore(rules, path):
+        if check_ignore(rules, path, is_dir=os.path.isdir(path)):
             print(path)
 
 def gitignore_parse1(raw):
@@ -941,18 +3011,171 @@ def gitignore_parse(lines):
 class GitIgnore(object):
     absolute = None
     scoped = None
+    hash = None # SHA-1 identifying the rules, see gitignore_read.
 
     def __init__(self, absolute, scoped):
         self.absolute = absolute
         self.scoped = scoped
 
+def gitignore_glob_regex(pattern):
+    """Translate a gitignore glob to a regex: * and ? never match a /,
+    a leading **/ matches any leading directories, /**/ zero or more
+    directories, and a trailing /** everything inside."""
+    ret = list()
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        at_segment = i == 0 or pattern[i-1] == "/"
+        if at_segment and pattern.startswith("**/", i):
+            ret.append("(?:.*/)?")
+            i += 3
+        elif at_segment and pattern[i:] == "**":
+            ret.append(".*")
+            i += 2
+        elif c == "*":
+            while i < len(pattern) and pattern[i] == "*":
+                i += 1
+            ret.append("[^/]*")
+        elif c == "?":
+            ret.append("[^/]")
+            i += 1
+        elif c == "[":
+            end = pattern.find("]", i + 2)
+            if end < 0:
+                ret.append(re.escape(c))
+                i += 1
+            else:
+                body = pattern[i+1:end]
+                if body[0] in "!^":
+                    body = "^" + body[1:]
+                ret.append("[" + body.replace("\\", "\\\\") + "]")
+                i = end + 1
+        elif c == "\\" and i + 1 < len(pattern):
+            ret.append(re.escape(pattern[i+1]))
+            i += 2
+        else:
+            ret.append(re.escape(c))
+            i += 1
+    return "".join(ret)
+
+class GitIgnoreRuleset(object):
+    """The rules of one ignore file, compiled once.
+
+    Rules are numbered in file order.  Plain names and *.ext patterns go
+    in hash tables, other patterns on the basename in one combined
+    regex, and anchored patterns in combined regexes keyed by their
+    first path component when it's a literal.  In the regexes, rules are
+    tried last-first so the first alternative that matches is the one
+    git would pick.  Whatever the table, the highest numbered match
+    wins, which keeps "last match wins"."""
+
+    def __init__(self, rules):
+        self.values = list()
+        parsed = list()
+        for (pattern, value) in rules:
+            dir_only = pattern.endswith("/")
+            pattern = pattern.rstrip("/")
+            # A slash anywhere but at the end anchors the pattern to the
+            # directory of the ignore file.
+            anchored = "/" in pattern
+            pattern = pattern.lstrip("/")
+            if not pattern:
+                continue
+            parsed.append((len(self.values), pattern, anchored, dir_only))
+            self.values.append(value)
+
+        self.for_files = self.compile([p for p in parsed if not p[3]])
+        self.for_dirs = self.compile(parsed)
+        # Best basename match, per basename; the same names (__init__.py,
+        # Makefile...) come back over and over in a tree.
+        self.basename_cache = (dict(), dict())
+
+    @staticmethod
+    def compile(parsed):
+        literals = dict()
+        exts = dict()
+        basename = list()
+        anchored = dict() # First path component -> patterns
+        anchored_any = list()
+
+        for (n, pattern, is_anchored, _) in parsed:
+            if is_anchored:
+                first = pattern.split("/", 1)[0]
+                if any(c in first for c in "*?[\\"):
+                    anchored_any.append((n, pattern))
+                else:
+                    anchored.setdefault(first, list()).append((n, pattern))
+            elif not any(c in pattern for c in "*?[\\"):
+                literals[pattern] = n
+            elif (pattern.startswith("*.") and "." not in pattern[2:]
+                  and not any(c in pattern[2:] for c in "*?[\\")):
+                exts[pattern[1:]] = n
+            else:
+                basename.append((n, pattern))
+
+        def combine(patterns):
+            if not patterns:
+                return None
+            return re.compile("|".join(f"(?P<r{n}>{gitignore_glob_regex(p)})"
+                                       for (n, p) in reversed(patterns)),
+                              re.DOTALL)
+
+        return (literals, exts, combine(basename),
+                {k: combine(v) for k, v in anchored.items()}, combine(anchored_any))
+
+    def match_basename(self, base, is_dir):
+        cache = self.basename_cache[is_dir]
+        best = cache.get(base)
+        if best is not None:
+            return best
+
+        literals, exts, basename_re, _, _ = self.for_dirs if is_dir else self.for_files
+        best = literals.get(base, -1)
+
+        dot = base.rfind(".")
+        if dot >= 0:
+            best = max(best, exts.get(base[dot:], -1))
+
+        if basename_re:
+            m = basename_re.fullmatch(base)
+            if m:
+                best = max(best, int(m.lastgroup[1:]))
+
+        cache[base] = best
+        return best
+
+    def match(self, path, is_dir=False):
+        """True if PATH, relative to this ruleset's directory, is ignored,
+        False if re-included by a ! rule, None if no rule matches."""
+        _, _, _, anchored, anchored_any = self.for_dirs if is_dir else self.for_files
+        best = self.match_basename(path[path.rfind("/") + 1:], is_dir)
+
+        if anchored:
+            regex = anchored.get(path.split("/", 1)[0])
+            if regex:
+                m = regex.fullmatch(path)
+                if m:
+                    best = max(best, int(m.lastgroup[1:]))
+
+        if anchored_any:
+            m = anchored_any.fullmatch(path)
+            if m:
+                best = max(best, int(m.lastgroup[1:]))
+
+        return None if best < 0 else self.values[best]
+
 def gitignore_read(repo):
     ret = GitIgnore(absolute=list(), scoped=dict())
+    # Hash every rule source, so caches built under other rules can be
+    # told apart.
+    digest = hashlib.sha1()
 
     repo_file = os.path.join(repo.gitdir, "info/exclude")
     if os.path.exists(repo_file):
         with open(repo_file, "r") as f:
-            ret.absolute.append(gitignore_parse(f.readlines()))
+            lines = f.readlines()
+            digest.update(("".join(lines) + "\x00").encode("utf8"))
+            ret.absolute.append(GitIgnoreRuleset(gitignore_parse(lines)))
 
     if "XDG_CONFIG_HOME" in os.environ:
         config_home = os.environ["XDG_CONFIG_HOME"]
@@ -962,7 +3185,9 @@ def gitignore_read(repo):
 
     if os.path.exists(global_file):
         with open(global_file, "r") as f:
-            ret.absolute.append(gitignore_parse(f.readlines()))
+            lines = f.readlines()
+            digest.update(("".join(lines) + "\x00").encode("utf8"))
+            ret.absolute.append(GitIgnoreRuleset(gitignore_parse(lines)))
 
     index = index_read(repo)
 
@@ -971,21 +3196,21 @@ def gitignore_read(repo):
             dir_name = os.path.dirname(entry.name)
             contents = object_read(repo, entry.sha)
             lines = contents.blobdata.decode("utf8").splitlines()
-            ret.scoped[dir_name] = gitignore_parse(lines)
+            ret.scoped[dir_name] = GitIgnoreRuleset(gitignore_parse(lines))
+            digest.update(f"{entry.name}\x00{entry.sha}\x00".encode("utf8"))
+    ret.hash = digest.digest()
     return ret
 
-def check_ignore1(rules, path):
-    result = None
-    for (pattern, value) in rules:
-        if fnmatch(path, pattern):
-            result = value
-    return result
+def check_ignore1(rules, path, is_dir=False):
+    return rules.match(path, is_dir)
 
-def check_ignore_scoped(rules, path):
+def check_ignore_scoped(rules, path, is_dir=False):
     parent = os.path.dirname(path)
     while True:
         if parent in rules:
-            result = check_ignore1(rules[parent], path)
+            # Patterns are relative to the directory of their .gitignore
+            rel = path[len(parent) + 1:] if parent else path
+            result = check_ignore1(rules[parent], rel, is_dir)
             if result != None:
                 return result
         if parent == "":
@@ -993,23 +3218,32 @@ def check_ignore_scoped(rules, path):
         parent = os.path.dirname(parent)
     return None
 
-def check_ignore_absolute(rules, path):
-    parent = os.path.dirname(path)
+def check_ignore_absolute(rules, path, is_dir=False):
     for ruleset in rules:
-        result = check_ignore1(ruleset, path)
+        result = check_ignore1(ruleset, path, is_dir)
         if result != None:
             return result
     return False 
 
-def check_ignore(rules, path):
+def check_ignore_path(rules, path, is_dir=False):
+    """Whether PATH itself is ignored, without looking at its parents."""
+    result = check_ignore_scoped(rules.scoped, path, is_dir)
+    if result != None:
+        return result
+
+    return check_ignore_absolute(rules.absolute, path, is_dir)
+
+def check_ignore(rules, path, is_dir=False):
     if os.path.isabs(path):
         raise Exception("This function requires path to be relative to the repository's root")
 
-    result = check_ignore_scoped(rules.scoped, path)
-    if result != None:
-        return result
+    # Nothing inside an ignored directory can be re-included.
+    parts = path.split("/")
+    for i in range(1, len(parts)):
+        if check_ignore_path(rules, "/".join(parts[:i]), is_dir=True):
+            return True
 
-    return check_ignore_absolute(rules.absolute, path)
+    return check_ignore_path(rules, path, is_dir)
 
 
 def cmd_status(_):
@@ -1033,125 +3267,506 @@ def cmd_status_branch(repo):
     if branch: print(f"On branch {branch}")
     else: print(f"HEAD detached at {object_find(repo,'HEAD')}")
 
-def tree_to_dict(repo, ref,prefix=""):
-    ret = dict()
-    tree_sha = object_find(repo, ref, fmt=b"tree")
-    tree = object_read(repo, tree_sha)
-
-    for leaf in tree.items:
-        full_path = os.path.join(prefix, leaf.path)
+def index_tree_diff(repo, tree, index, prefix="", lo=0, hi=None):
+    """Like tree_diff, between TREE (a SHA, or None) and the entries
+    INDEX[LO:HI] under directory PREFIX, with the index on the new side.
+    A directory whose cache-tree node is valid and has the same SHA as
+    the tree is skipped without reading either, so a commit followed by
+    a few adds only looks at the directories those touched."""
+    entries = index.entries
+    if hi is None:
+        hi = len(entries)
+
+    node = cache_tree_find(index.cache_tree, prefix.rstrip("/"))
+    if node is not None and node.sha is not None and node.sha == tree and node.entry_count == hi - lo:
+        return
 
-        is_subtree = leaf.mode.startswith(b'04')
-        
-        if is_subtree:
-            ret.update(tree_to_dict(repo, leaf.sha, full_path))
+    # The index side as (key, name, entry or (lo, hi) of a directory),
+    # keyed like tree_leaf_sort_key so both lists merge in tree order.
+    staged = list()
+    k = lo
+    while k < hi:
+        rest = entries[k].name[len(prefix):]
+        slash = rest.find("/")
+        if slash < 0:
+            staged.append((rest, rest, entries[k]))
+            k += 1
         else:
-            ret[full_path] = leaf.sha
-    return ret
+            name = rest[:slash]
+            _, end = index_range(index, prefix + name)
+            staged.append((name + "/", name, (k, end)))
+            k = end
+
+    items = object_read(repo, tree).items if tree else []
+
+    i = j = 0
+    while i < len(items) or j < len(staged):
+        ka = tree_leaf_sort_key(items[i]) if i < len(items) else None
+        kb = staged[j][0] if j < len(staged) else None
+        if kb is None or (ka is not None and ka < kb):
+            x, y = items[i], None
+            i += 1
+        elif ka is None or kb < ka:
+            x, y = None, staged[j]
+            j += 1
+        else:
+            x, y = items[i], staged[j]
+            i += 1
+            j += 1
+
+        name = x.path if x else y[1]
+        path = prefix + name
+        if (x and x.mode.startswith(b'04')) or (y and type(y[2]) == tuple):
+            sub_lo, sub_hi = y[2] if y else (0, 0)
+            yield from index_tree_diff(repo, x and x.sha, index, path + "/", sub_lo, sub_hi)
+            continue
+
+        old = x and (x.mode, x.sha)
+        new = None
+        if y:
+            e = y[2]
+            new = (f"{e.mode_type:02o}{e.mode_perms:04o}".encode("ascii"), e.sha)
+        if old != new:
+            yield path, old, new
 
 def cmd_status_head_index(repo, index):
     print("Changes to be committed:")
 
-    head = tree_to_dict(repo, "HEAD")
-    for entry in index.entries:
-        if entry.name in head:
-            if head[entry.name] != entry.sha:
-                print("  modified:", entry.name)
-            del head[entry.name] 
+    head = None
+    if ref_resolve(repo, "HEAD"):
+        head = object_find(repo, "HEAD", fmt=b"tree")
+
+    for path, old, new in index_tree_diff(repo, head, index):
+        if old is None:
+            print("  added:   ", path)
+        elif new is None:
+            print("  deleted: ", path)
         else:
-            print("  added:   ", entry.name)
+            print("  modified:", path)
+
+
+class GitUntrackedCache(object):
+    """What the status walk found in each directory, so directories that
+    didn't change aren't read again.  Kept in its own file,
+    .git/wyag-untracked-cache, rather than in the index: git's UNTR
+    extension has a different format, and git warns about any index
+    extension it doesn't know.
+
+    Listings don't depend on the index, only on the ignore rules, which
+    is why they record every non-ignored file rather than just untracked
+    ones: staging a file doesn't touch its directory's mtime."""
 
-    for entry in head.keys():
-        print("  deleted: ", entry)
+    ignore_hash = None # GitIgnore.hash of the rules the listings follow
+    dirs = None        # dir -> (mtime_ns, files, [(subdir, ignored)])
+    trusted_before = None # Directories changed after this are racy.
+    dirty = False
 
+    def __init__(self, ignore_hash, dirs=None):
+        self.ignore_hash = ignore_hash
+        self.dirs = dirs if dirs is not None else dict()
+
+# Magic and version at the start of the untracked cache file.
+UNTRACKED_CACHE_HEADER = b"WYUC\x00\x00\x00\x01"
+
+def untracked_cache_get(repo, ignore):
+    """The untracked cache, reset if it was built under other rules than
+    IGNORE, or None if core.untrackedCache is off."""
+    if not repo.conf.getboolean("core", "untrackedcache", fallback=True):
+        return None
+
+    cache = None
+    written_ns = None
+    path = repo_path(repo, "wyag-untracked-cache")
+    try:
+        with open(path, "rb") as f:
+            written_ns = os.fstat(f.fileno()).st_mtime_ns
+            data = f.read()
+        if data.startswith(UNTRACKED_CACHE_HEADER):
+            cache = untracked_cache_parse(data[len(UNTRACKED_CACHE_HEADER):])
+    except FileNotFoundError:
+        pass
+    except (ValueError, IndexError):
+        cache = None # Truncated or corrupt: start over.
+
+    if cache is None or cache.ignore_hash != ignore.hash:
+        cache = GitUntrackedCache(ignore.hash)
+        cache.dirty = True
+    # Directories modified since the cache was written may have changed
+    # again in the same tick: only older ones are trusted.
+    cache.trusted_before = written_ns
+    return cache
+
+def untracked_cache_write(repo, cache):
+    """Save CACHE if the walk changed it."""
+    if cache is None or not cache.dirty:
+        return
+    lockfile_write(repo_path(repo, "wyag-untracked-cache"),
+                   UNTRACKED_CACHE_HEADER + untracked_cache_serialize(cache))
+    cache.dirty = False
+
+def untracked_cache_parse(data):
+    dirs = dict()
+    count = int.from_bytes(data[20:24], "big")
+    idx = 24
+
+    def name():
+        nonlocal idx
+        end = data.index(b'\x00', idx)
+        ret = data[idx:end].decode("utf8")
+        idx = end + 1
+        return ret
+
+    for i in range(count):
+        path = name()
+        mtime_ns = int.from_bytes(data[idx:idx+8], "big")
+        nfiles = int.from_bytes(data[idx+8:idx+12], "big")
+        idx += 12
+        files = [name() for _ in range(nfiles)]
+        nsubdirs = int.from_bytes(data[idx:idx+4], "big")
+        idx += 4
+        subdirs = list()
+        for _ in range(nsubdirs):
+            ignored = data[idx] != 0
+            idx += 1
+            subdirs.append((name(), ignored))
+        dirs[path] = (mtime_ns, files, subdirs)
+
+    return GitUntrackedCache(data[0:20], dirs)
+
+def untracked_cache_serialize(cache):
+    ret = bytearray(cache.ignore_hash)
+    ret += len(cache.dirs).to_bytes(4, "big")
+    for path in sorted(cache.dirs.keys()):
+        mtime_ns, files, subdirs = cache.dirs[path]
+        ret += path.encode("utf8") + b'\x00'
+        ret += mtime_ns.to_bytes(8, "big")
+        ret += len(files).to_bytes(4, "big")
+        for f in files:
+            ret += f.encode("utf8") + b'\x00'
+        ret += len(subdirs).to_bytes(4, "big")
+        for (d, ignored) in subdirs:
+            ret += bytes([ignored]) + d.encode("utf8") + b'\x00'
+    return bytes(ret)
+
+def worktree_dir_list(repo, rel_root, ignore=None, cache=None):
+    """List directory REL_ROOT as (files, [(subdir, ignored)]), leaving
+    out ignored files.  With CACHE, an unchanged directory costs a stat."""
+    path = os.path.join(repo.worktree, rel_root)
+
+    if cache is not None:
+        mtime_ns = os.stat(path).st_mtime_ns
+        cached = cache.dirs.get(rel_root)
+        if (cached and cached[0] == mtime_ns and cache.trusted_before is not None
+            and mtime_ns < cache.trusted_before):
+            return cached[1], cached[2]
+
+    files = list()
+    subdirs = list()
+    with os.scandir(path) as it:
+        for entry in it:
+            rel_path = entry.name if not rel_root else rel_root + "/" + entry.name
+            # Symlinks, even to directories, are files to git.
+            if entry.is_dir(follow_symlinks=False):
+                if rel_path == ".git":
+                    continue
+                subdirs.append((entry.name, bool(ignore and check_ignore_path(ignore, rel_path, is_dir=True))))
+            elif not (ignore and check_ignore_path(ignore, rel_path)):
+                files.append(entry.name)
+
+    if cache is not None:
+        if cache.dirs.get(rel_root) != (mtime_ns, files, subdirs):
+            cache.dirs[rel_root] = (mtime_ns, files, subdirs)
+            cache.dirty = True
+
+    return files, subdirs
+
+def worktree_files(repo, ignore=None, tracked_dirs=(), cache=None, root=""):
+    """Every file of the worktree, or of its directory ROOT, relative to
+    the worktree root and sorted.
+
+    With IGNORE rules, ignored files are left out and ignored directories
+    are not descended into, unless they're in TRACKED_DIRS (i.e. hold
+    files from the index).  CACHE is a GitUntrackedCache matching
+    IGNORE."""
+    ret = list()
+    root_ignored = bool(root and ignore and check_ignore(ignore, root, is_dir=True))
+    stack = [(root, root_ignored)]
+    seen = set()
+
+    while stack:
+        rel_root, ignored = stack.pop()
+        seen.add(rel_root)
+        files, subdirs = worktree_dir_list(repo, rel_root, ignore, cache)
+        prefix = rel_root + "/" if rel_root else ""
+
+        if not ignored:
+            for f in files:
+                ret.append(prefix + f)
+
+        for (d, sub_ignored) in subdirs:
+            rel_path = prefix + d
+            sub_ignored = ignored or sub_ignored
+            if sub_ignored and not rel_path in tracked_dirs:
+                continue
+            stack.append((rel_path, sub_ignored))
+
+    # Forget directories that are gone, or that we no longer walk.
+    if cache is not None and root == "" and len(seen) != len(cache.dirs):
+        for d in list(cache.dirs.keys()):
+            if not d in seen:
+                del cache.dirs[d]
+        cache.dirty = True
+
+    ret.sort()
+    return ret
+
+def index_dirs(index):
+    """Every directory holding an index entry, at any depth."""
+    ret = set()
+    for e in index.entries:
+        d = os.path.dirname(e.name)
+        while d and not d in ret:
+            ret.add(d)
+            d = os.path.dirname(d)
+    return ret
+
+def status_untracked(repo, index, ignore=None, cache=None):
+    """Yield worktree files missing from INDEX and not ignored, by
+    merge-walking the sorted index names against the sorted worktree
+    listing.  Ignored directories without tracked files are skipped
+    entirely."""
+    names = sorted(e.name for e in index.entries)
+    i = 0
+    for f in worktree_files(repo, ignore, index_dirs(index), cache):
+        while i < len(names) and names[i] < f:
+            i += 1
+        if i < len(names) and names[i] == f:
+            i += 1
+        else:
+            yield f
 
 def cmd_status_index_worktree(repo, index):
     print("Changes not staget for commit")
     ignore = gitignore_read(repo)
-    gitdir_prefix=repo.gitdir + os.path.sep
-    all_files = list()
-    
-    for (root, _, files) in os.walk(repo.worktree, True):
-        if root==repo.gitdir or root.startswith(gitdir_prefix):
-            continue
-        for f in files:
-            full_path = os.path.join(root, f)
-            rel_path = os.path.relpath(full_path, repo.worktree)
-            all_files.append(rel_path)
+
+    cache = untracked_cache_get(repo, ignore)
+
+    refreshed = False
 
     for entry in index.entries:
         full_path= os.path.join(repo.worktree ,entry.name)
 
-        if not os.path.exists(full_path): print("deleted", entry.name)
+        try:
+            stat = os.lstat(full_path)
+        except FileNotFoundError:
+            stat = None
+
+        if stat is None: print("deleted", entry.name)
         else:
-            stat = os.stat(full_path)
-            ctime_ns = entry.ctime[0] * 10**9 + entry.ctime[1]
-            mtime_ns = entry.mtime[0] * 10**9 + entry.mtime[1]
-            if (stat.st_ctime_ns != ctime_ns) or (stat.st_mtime_ns != mtime_ns):
-                # @FIXME This *will* crash on symlinks to dir.
-                with open(full_path, "rb") as fd:
-                    new_sha = object_hash(fd, b"blob", None)
-                    # If the hashes are the same, the files are actually the same.
-                    same = entry.sha == new_sha
-
-                    if not same:
-                        print("  modified:", entry.name)
-
-        if entry.name in all_files:
-            all_files.remove(entry.name)
-    
+            matches = index_entry_stat_matches(entry, stat)
+            if not matches or index_entry_is_racy(index, entry):
+                hashed = worktree_hash(full_path)
+                if hashed is None:
+                    print("deleted", entry.name)
+                    continue
+                new_sha, stat = hashed
+                # If the hashes are the same, the files are actually the same.
+                same = entry.sha == new_sha
+
+                if not same:
+                    print("  modified:", entry.name)
+                else:
+                    # Remember the file is clean, so the next
+                    # status won't hash it again.
+                    index_entry_refresh(entry, stat)
+                    refreshed = True
+
     print()
     print("untracked files")
 
-    for f in all_files:
-        if not check_ignore(ignore,f):
-            print(" ",f)
-    
+    for f in status_untracked(repo, index, ignore, cache):
+        print(" ",f)
 
+    if refreshed:
+        # Only an optimization: skipped if the index changed meanwhile.
+        index_write_if_unchanged(repo, index)
+    untracked_cache_write(repo, cache)
+    
 
 
-def index_write(repo, index):
-    with open(repo_file(repo, "index"), "wb") as f:
-
-        f.write(b"DIRC")
-        f.write(index.version.to_bytes(4, "big"))
-        f.write(len(index.entries).to_bytes(4, "big"))
-
-        idx = 0
-        for e in index.entries:
-            f.write(e.ctime[0].to_bytes(4, "big"))
-            f.write(e.ctime[1].to_bytes(4, "big"))
-            f.write(e.mtime[0].to_bytes(4, "big"))
-            f.write(e.mtime[1].to_bytes(4, "big"))
-            f.write(e.dev.to_bytes(4, "big"))
-            f.write(e.ino.to_bytes(4, "big"))
-
-            mode = (e.mode_type << 12) | e.mode_perms
-            f.write(mode.to_bytes(4, "big"))
-            f.write(e.uid.to_bytes(4, "big"))
-            f.write(e.gid.to_bytes(4, "big"))
-            f.write(e.fsize.to_bytes(4, "big"))
-            f.write(int(e.sha, 16).to_bytes(20, "big"))
-
-            flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
-
-            name_bytes = e.name.encode("utf8")
-            bytes_len = len(name_bytes)
-            if bytes_len >= 0xFFF:
-                name_length = 0xFFF
-            else:
-                name_length = bytes_len
 
-            f.write((flag_assume_valid | e.flag_stage | name_length).to_bytes(2, "big"))
-            f.write(name_bytes)
-            f.write((0).to_bytes(1, "big"))
+def index_serialize(index, version):
+    """INDEX in the on-disk format VERSION, checksum included."""
+    buf = bytearray(b"DIRC")
+    buf += struct.pack(">LL", version, len(index.entries))
+    pack = INDEX_ENTRY.pack
 
-            idx += 62 + len(name_bytes) + 1
+    prev_name = b''
+    for e in index.entries:
+        name_bytes = e.name.encode("utf8") if e.raw_name is None else e.raw_name
+        # Names of 0xFFF bytes and more are NUL-terminated, see index_read.
+        name_length = min(len(name_bytes), 0xFFF)
+
+        flag_assume_valid = 0x1 << 15 if e.flag_assume_valid else 0
+        flag_extended = 0
+        if e.flag_skip_worktree or e.flag_intent_to_add:
+            flag_extended = 0x1 << 14
+
+        start = len(buf)
+        buf += pack(e.ctime[0], e.ctime[1], e.mtime[0], e.mtime[1], e.dev, e.ino,
+                    (e.mode_type << 12) | e.mode_perms, e.uid, e.gid, e.fsize,
+                    bytes.fromhex(e.sha),
+                    flag_assume_valid | flag_extended | e.flag_stage | name_length)
+
+        if flag_extended:
+            buf += struct.pack(">H", (0x1 << 14 if e.flag_skip_worktree else 0)
+                                     | (0x1 << 13 if e.flag_intent_to_add else 0))
+
+        if version == 4:
+            # Drop what doesn't match the previous name, keep the
+            # common prefix.
+            common = 0
+            limit = min(len(prev_name), len(name_bytes))
+            while common < limit and prev_name[common] == name_bytes[common]:
+                common += 1
+            buf += pack_ofs_encode(len(prev_name) - common)
+            buf += name_bytes[common:]
+            buf += b'\x00'
+            prev_name = name_bytes
+        else:
+            # The name's NUL and the padding make the entry a multiple
+            # of eight bytes long.
+            buf += name_bytes
+            buf += bytes(8 - (len(buf) - start) % 8)
+
+    for (signature, data) in index_extensions(index):
+        buf += signature
+        buf += len(data).to_bytes(4, "big")
+        buf += data
+
+    buf += hashlib.sha1(buf).digest()
+    return buf
+
+def repo_fsync(repo, component):
+    """Whether core.fsync (a comma separated list, like git's) asks for
+    COMPONENT to be fsynced."""
+    parts = [p.strip() for p in repo.conf.get("core", "fsync", fallback="").split(",")]
+    return component in parts or "all" in parts
+
+def lockfile_open(path, timeout=0, stats=None):
+    """Create PATH.lock exclusively and return its fd.  While another
+    process holds it, retry with growing sleeps for up to TIMEOUT
+    seconds.  STATS, if given, counts locks taken, contended attempts
+    and timeouts."""
+    lock = path + ".lock"
+    deadline = time.monotonic() + timeout
+    delay = 0.001
+    while True:
+        try:
+            fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            if stats is not None:
+                stats["locked"] += 1
+            return fd
+        except FileExistsError:
+            if stats is not None:
+                stats["contended"] += 1
+            if time.monotonic() >= deadline:
+                if stats is not None:
+                    stats["timeouts"] += 1
+                raise Exception(f"Unable to create {lock}: File exists. Another wyag process seems to be running.")
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+def lockfile_write(path, data, fsync=False):
+    """Atomically replace PATH with DATA.  DATA goes to PATH.lock, which
+    is created exclusively so concurrent writers fail instead of
+    interleaving, then renamed over PATH."""
+    lockfile_commit(path, lockfile_open(path), data, fsync)
+
+def lockfile_rollback(path, fd):
+    """Give up the lock FD on PATH, leaving PATH as it was."""
+    os.close(fd)
+    os.unlink(path + ".lock")
+
+def lockfile_commit(path, fd, data, fsync=False):
+    """Write DATA to FD, the lock held on PATH, and rename it over PATH.
+    On failure, the lock is removed and PATH left alone."""
+    lock = path + ".lock"
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(lock, path)
+    except BaseException:
+        if os.path.exists(lock):
+            os.unlink(lock)
+        raise
 
-            if idx % 8 != 0:
-                pad = 8 - (idx % 8)
-                f.write((0).to_bytes(pad, "big"))
-                idx += pad
+def index_write(repo, index):
+    version = repo.conf.getint("index", "version", fallback=index.version)
+    extended = any(e.flag_skip_worktree or e.flag_intent_to_add for e in index.entries)
+    if version == 2 and extended:
+        version = 3 # Version 2 can't store extended flags.
+    index.version = version
+
+    index_smudge_racy(index, time.time_ns())
+
+    path = repo_file(repo, "index")
+    data = index_serialize(index, version)
+    fsync = repo_fsync(repo, "index")
+    if index.lock is not None:
+        fd, index.lock = index.lock, None
+        lockfile_commit(path, fd, data, fsync=fsync)
+    else:
+        lockfile_write(path, data, fsync=fsync)
+
+def index_read_locked(repo):
+    """Take index.lock, then read the index.  The lock is held until
+    index_write writes the index through it, or index_unlock gives up,
+    so concurrent read-modify-writes can't lose each other's changes.
+    Like git's repo_hold_locked_index."""
+    path = repo_file(repo, "index")
+    fd = lockfile_open(path)
+    try:
+        index = index_read(repo)
+    except BaseException:
+        lockfile_rollback(path, fd)
+        raise
+    index.lock = fd
+    return index
+
+def index_unlock(repo, index):
+    """Release INDEX's lock if it wasn't written: a no-op after
+    index_write, for finally clauses."""
+    if index.lock is not None:
+        fd, index.lock = index.lock, None
+        lockfile_rollback(repo_file(repo, "index"), fd)
+
+def index_write_if_unchanged(repo, index):
+    """Write INDEX, read without its lock, unless the index file changed
+    since or another process holds the lock.  For writes that are only
+    an optimization, like status saving refreshed stat data.  Returns
+    whether it wrote."""
+    path = repo_file(repo, "index")
+    try:
+        index.lock = lockfile_open(path)
+    except Exception:
+        return False # Someone's writing it: their index wins.
+    try:
+        try:
+            with open(path, "rb") as f:
+                f.seek(max(os.fstat(f.fileno()).st_size - 20, 0))
+                checksum = f.read()
+        except FileNotFoundError:
+            checksum = None
+        if checksum != index.checksum:
+            return False
+        index_write(repo, index)
+        return True
+    finally:
+        index_unlock(repo, index)
 
 
 def cmd_rm(args):
@@ -1159,79 +3774,183 @@ def cmd_rm(args):
     rm(repo,args.path)
 
 def rm(repo,paths,delete=True,skip_missing=True):
-    index=index_read(repo)
-    worktree=repo.worktree + os.sep
-    
-    abspaths = set()
-    
-    for path in paths:
-        abspath = os.path.abspath(path)
-        if abspath.startswith(worktree):
-            abspaths.add(abspath)
-        else:
-            raise Exception(f"Cannot remove paths outside of worktree: {paths}")
+    index=index_read_locked(repo)
+    try:
+        worktree=repo.worktree + os.sep
 
-    kept_entries = list()
-    remove = list()
+        relpaths = set()
+    
+        for path in paths:
+            abspath = os.path.abspath(path)
+            if abspath.startswith(worktree):
+                relpaths.add(os.path.relpath(abspath, repo.worktree))
+            else:
+                raise Exception(f"Cannot remove paths outside of worktree: {paths}")
 
-    for e in index.entries:
-        full_path = os.path.join(repo.worktree, e.name)
+        remove = list()
+        missing = list()
 
-        if full_path in abspaths:
-            remove.append(full_path)
-            abspaths.remove(full_path)
-        else:
-            kept_entries.append(e) 
+        for relpath in sorted(relpaths):
+            if index_remove(index, relpath):
+                remove.append(os.path.join(repo.worktree, relpath))
+            else:
+                missing.append(relpath)
 
-    if len(abspaths) > 0 and not skip_missing:
-        raise Exception(f"Cannot remove paths not in the index: {abspaths}")
+        if len(missing) > 0 and not skip_missing:
+            raise Exception(f"Cannot remove paths not in the index: {missing}")
 
-    if delete:
-        for path in remove:
-            os.unlink(path)
+        if delete:
+            for path in remove:
+                os.unlink(path)
 
-    index.entries = kept_entries
-    index_write(repo, index)
+        index_write(repo, index)
+    finally:
+        index_unlock(repo, index)
 
 
 def cmd_add(args):
     repo = repo_find()
-    add(repo,args.path)
-
-def add(repo, paths, delete=True, skip_missing=False):
-    
-    rm (repo, paths, delete=False, skip_missing=True)
-
-    worktree = repo.worktree + os.sep
-    clean_paths = set()
-    
-    for path in paths:
-        abspath = os.path.abspath(path)
-        if not (abspath.startswith(worktree) and os.path.isfile(abspath)):
-            raise Exception(f"Not a file, or outside the worktree: {paths}")
-        relpath = os.path.relpath(abspath, repo.worktree)
-        clean_paths.add((abspath,  relpath))
-
-    index = index_read(repo)
-
-    for (abspath, relpath) in clean_paths:
+    add(repo,args.path, workers=args.workers)
+
+# Below this many files, starting worker processes costs more than it saves.
+ADD_PARALLEL_MIN = 64
+
+# Each worker process opens the repository once, in add_worker_init.
+add_worker_repo = None
+
+def add_worker_init(worktree):
+    global add_worker_repo
+    add_worker_repo = GitRepository(worktree)
+    # Workers only write objects, caching them would only waste memory.
+    add_worker_repo.object_cache = None
+
+def worktree_hash(abspath, repo=None):
+    """Hash ABSPATH as a blob, writing it to REPO if given.  A symlink
+    is hashed as its target path, like git does, whatever it points to.
+    Returns the SHA and the lstat data, or None if the file is gone."""
+    try:
+        stat = os.lstat(abspath)
+        if S_ISLNK(stat.st_mode):
+            return object_write(GitBlob(os.fsencode(os.readlink(abspath))), repo), stat
         with open(abspath, "rb") as fd:
-            sha = object_hash(fd, b"blob", repo)
-
-            stat = os.stat(abspath)
-
-            ctime_s = int(stat.st_ctime)
-            ctime_ns = stat.st_ctime_ns % 10**9
-            mtime_s = int(stat.st_mtime)
-            mtime_ns = stat.st_mtime_ns % 10**9
+            return object_hash(fd, b"blob", repo), stat
+    except (FileNotFoundError, NotADirectoryError):
+        return None
 
-            entry = GitIndexEntry(ctime=(ctime_s, ctime_ns), mtime=(mtime_s, mtime_ns), dev=stat.st_dev, ino=stat.st_ino,
-                                  mode_type=0b1000, mode_perms=0o644, uid=stat.st_uid, gid=stat.st_gid,
-                                  fsize=stat.st_size, sha=sha, flag_assume_valid=False,
-                                  flag_stage=False, name=relpath)
-            index.entries.append(entry)
+def add_worker_hash(abspath):
+    """Write ABSPATH as a blob, return its SHA and its stat data."""
+    return worktree_hash(abspath, add_worker_repo)
+
+def add_workers(repo, workers=None):
+    if workers is None:
+        workers = repo.conf.getint("core", "workers", fallback=0) or os.cpu_count() or 1
+    return max(workers, 1)
+
+def add_hash_all(repo, abspaths, workers=None):
+    """Hash and write ABSPATHS, in parallel if it's worth it.  Returns
+    (sha, stat) pairs in the order of ABSPATHS, None for files that
+    vanished since they were listed."""
+    workers = add_workers(repo, workers)
+
+    if workers > 1 and len(abspaths) >= ADD_PARALLEL_MIN:
+        try:
+            pool = ProcessPoolExecutor(max_workers=workers,
+                                       initializer=add_worker_init,
+                                       initargs=(repo.worktree,))
+        except (OSError, NotImplementedError):
+            pool = None # No multiprocessing support here, do it ourselves.
+        if pool is not None:
+            # Errors while hashing are real ones: let them through.
+            with pool:
+                return list(pool.map(add_worker_hash, abspaths, chunksize=16))
+
+    return [worktree_hash(abspath, repo) for abspath in abspaths]
+
+def index_range(index, prefix):
+    """Positions (lo, hi) of the entries under directory PREFIX."""
+    if prefix == "":
+        return 0, len(index.entries)
+    # "0" sorts right after "/"
+    lo = bisect_left(index.entries, prefix + "/", key=lambda e: e.name)
+    hi = bisect_left(index.entries, prefix + "0", lo=lo, key=lambda e: e.name)
+    return lo, hi
+
+def add_expand(repo, index, relpath, ignore, cache=None):
+    """Expand directory RELPATH ("" for the whole worktree) to the
+    files add should look at: everything not ignored under it, plus
+    tracked files.  Returns them with the tracked files that are gone."""
+    files = set(worktree_files(repo, ignore, index_dirs(index), cache, root=relpath))
+    gone = list()
+    lo, hi = index_range(index, relpath)
+    for e in index.entries[lo:hi]:
+        if os.path.lexists(os.path.join(repo.worktree, e.name)):
+            files.add(e.name)
+        else:
+            gone.append(e.name)
+    return files, gone
 
-    index_write(repo, index)
+def add(repo, paths, workers=None):
+    worktree = repo.worktree + os.sep
+    index = index_read_locked(repo)
+    try:
+        ignore = None
+        cache = None
+        clean_paths = set()
+        gone = list()
+
+        for path in paths:
+            abspath = os.path.abspath(path)
+            if abspath == repo.worktree or (abspath.startswith(worktree) and os.path.isdir(abspath)
+                                            and not os.path.islink(abspath)):
+                if ignore is None:
+                    ignore = gitignore_read(repo)
+                    cache = untracked_cache_get(repo, ignore)
+                relpath = "" if abspath == repo.worktree else os.path.relpath(abspath, repo.worktree)
+                files, missing = add_expand(repo, index, relpath, ignore, cache)
+                for f in files:
+                    clean_paths.add((os.path.join(repo.worktree, f), f))
+                gone.extend(missing)
+            elif abspath.startswith(worktree) and (os.path.islink(abspath) or os.path.isfile(abspath)):
+                relpath = os.path.relpath(abspath, repo.worktree)
+                clean_paths.add((abspath,  relpath))
+            else:
+                raise Exception(f"Not a file, or outside the worktree: {paths}")
+
+        # Skip files whose stat data says they're what the index has.
+        todo = list()
+        for (abspath, relpath) in clean_paths:
+            i = index_find(index, relpath)
+            if i is not None:
+                entry = index.entries[i]
+                try:
+                    stat = os.lstat(abspath)
+                except FileNotFoundError:
+                    gone.append(relpath)
+                    continue
+                if (index_entry_stat_matches(entry, stat)
+                    and not index_entry_is_racy(index, entry)):
+                    continue
+            todo.append((abspath, relpath))
+
+        # Sorted, so parallel and serial runs produce the same index.
+        todo.sort()
+        hashed = add_hash_all(repo, [abspath for (abspath, _) in todo], workers)
+
+        for ((abspath, relpath), result) in zip(todo, hashed):
+            if result is None:
+                # Deleted while we were at it: drop it like any gone file.
+                gone.append(relpath)
+                continue
+            sha, stat = result
+            index_insert(index, index_entry_from_stat(relpath, sha, stat))
+
+        for name in gone:
+            index_remove(index, name)
+
+        index_write(repo, index)
+        untracked_cache_write(repo, cache)
+    finally:
+        index_unlock(repo, index)
 
 
 def gitconfig_read():
@@ -1254,16 +3973,24 @@ def gitconfig_user_get(config):
     return None
 
 def tree_from_index(repo, index):
+    """Write the trees INDEX describes and return the root tree's SHA.
+    Directories the index's cache-tree still knows are reused as is, so
+    only trees on changed paths get serialized and written.  The index's
+    cache-tree is then replaced by a fully valid one."""
     contents = dict()
     contents[""] = list()
+    counts = dict() # Number of entries under each directory, recursively
 
     for entry in index.entries:
         dirname = os.path.dirname(entry.name)
 
         key = dirname
-        while key != "":
+        while True:
             if not key in contents:
                 contents[key] = list()
+            counts[key] = counts.get(key, 0) + 1
+            if key == "":
+                break
             key = os.path.dirname(key)
 
         contents[dirname].append(entry)
@@ -1271,28 +3998,41 @@ def tree_from_index(repo, index):
     sorted_paths = sorted(contents.keys(), key=len, reverse=True)
 
     sha = None
+    nodes = dict()
 
     for path in sorted_paths:
-        tree = GitTree()
+        count = counts.get(path, 0)
+        cached = cache_tree_find(index.cache_tree, path)
 
-        for entry in contents[path]:
-            
-            if isinstance(entry, GitIndexEntry): # Regular entry (a file)
+        # Like git's cache_tree_fully_valid, trust a node only if its
+        # tree is still there: gc may have dropped it since.
+        if cached and cached.sha and cached.entry_count == count and object_exists(repo, cached.sha):
+            sha = cached.sha
+        else:
+            tree = GitTree()
 
-                leaf_mode = f"{entry.mode_type:02o}{entry.mode_perms:04o}".encode("ascii")
-                leaf = GitTreeLeaf(mode = leaf_mode, path=os.path.basename(entry.name), sha=entry.sha)
-            else: # Tree.  We've stored it as a pair: (basename, SHA)
-                leaf = GitTreeLeaf(mode = b"040000", path=entry[0], sha=entry[1])
+            for entry in contents[path]:
 
-            tree.items.append(leaf)
+                if isinstance(entry, GitIndexEntry): # Regular entry (a file)
 
-        sha = object_write(tree, repo)
-        
-        parent = os.path.dirname(path)
-        
-        base = os.path.basename(path) 
-        
-        contents[parent].append((base, sha))
+                    leaf_mode = f"{entry.mode_type:02o}{entry.mode_perms:04o}".encode("ascii")
+                    leaf = GitTreeLeaf(mode = leaf_mode, path=os.path.basename(entry.name), sha=entry.sha)
+                else: # Tree.  We've stored it as a pair: (basename, SHA)
+                    leaf = GitTreeLeaf(mode = b"040000", path=entry[0], sha=entry[1])
+
+                tree.items.append(leaf)
+
+            sha = object_write(tree, repo)
+
+        nodes[path] = GitCacheTree(os.path.basename(path), count, sha)
+
+        if path != "":
+            contents[os.path.dirname(path)].append((os.path.basename(path), sha))
+
+    for path, node in nodes.items():
+        if path != "":
+            nodes[os.path.dirname(path)].children[node.name] = node
+    index.cache_tree = nodes[""]
 
     return sha
 
@@ -1320,24 +4060,603 @@ def commit_create(repo, tree, parent, author, timestamp, message):
 
 def cmd_commit(args):
     repo = repo_find()
+    index = index_read_locked(repo)
+    try:
+        # Create trees, grab back SHA for the root tree.
+        tree = tree_from_index(repo, index)
+        # Save the now valid cache-tree for the next commit.
+        index_write(repo, index)
+
+        # Create the commit object itself
+        parent = ref_resolve(repo, "HEAD")
+        commit = commit_create(repo,
+                               tree,
+                               parent,
+                               gitconfig_user_get(gitconfig_read()),
+                               datetime.now(),
+                               args.message)
+
+        # Update HEAD so our commit is now the tip of the active branch, or
+        # HEAD itself if detached.  Fails if someone else moved it meanwhile.
+        summary = args.message.strip().split("\n")[0]
+        tx = GitRefTransaction(repo)
+        tx.update("HEAD", commit, old=parent or ZERO_SHA,
+                  message=f"commit{'' if parent else ' (initial)'}: {summary}")
+        tx.commit()
+    finally:
+        index_unlock(repo, index)
+
+
+def cmd_gc(args):
+    repo = repo_find()
+    gc(repo, window=args.window, depth=args.depth)
+
+def ref_tips(repo):
+    """SHAs every ref and HEAD point to."""
+    ret = list()
+
+    def collect(refs):
+        for v in refs.values():
+            if type(v) == dict:
+                collect(v)
+            elif v:
+                ret.append(v)
+
+    collect(ref_list(repo))
+    head = ref_resolve(repo, "HEAD")
+    if head:
+        ret.append(head)
+    return ret
+
+def reflog_shas(repo):
+    """The old and new SHAs of every reflog entry, skipping those whose
+    object is already gone."""
+    ret = set()
+    logs = repo_dir(repo, "logs")
+    if not logs:
+        return ret
+    for root, _, files in os.walk(logs):
+        for name in files:
+            with open(os.path.join(root, name), "r") as f:
+                for line in f:
+                    ret.update(line.split(" ", 2)[:2])
+    ret.discard(ZERO_SHA)
+    return {sha for sha in ret if HASH_RE.match(sha) and object_exists(repo, sha)}
+
+def objects_reachable(repo):
+    """Every object reachable from refs, HEAD, reflogs and the index, as
+    a list of (sha, fmt, data, path) tuples.  PATH is the name the
+    object was found under, used to pick delta bases."""
+    roots = [(sha, "") for sha in ref_tips(repo)]
+    roots.extend((sha, "") for sha in sorted(reflog_shas(repo)))
     index = index_read(repo)
-    
-    # Create trees, grab back SHA for the root tree.
-    tree = tree_from_index(repo, index)
-
-    # Create the commit object itself
-    commit = commit_create(repo,
-                           tree,
-                           object_find(repo, "HEAD"),
-                           gitconfig_user_get(gitconfig_read()),
-                           datetime.now(),
-                           args.message)
-
-    # Update HEAD so our commit is now the tip of the active branch.
-    active_branch = branch_get_active(repo)
-    if active_branch: # If we're on a branch, we update refs/heads/BRANCH
-        with open(repo_file(repo, os.path.join("refs/heads", active_branch)), "w") as fd:
-            fd.write(commit + "\n")
-    else: # Otherwise, we update HEAD itself.
-        with open(repo_file(repo, "HEAD"), "w") as fd:
-            fd.write("\n")
\ No newline at end of file
+    for e in index.entries:
+        roots.append((e.sha, e.name))
+
+    # The next commit reuses the trees of valid cache-tree nodes.
+    nodes = [(index.cache_tree, "")] if index.cache_tree else []
+    while nodes:
+        node, path = nodes.pop()
+        if node.sha and object_exists(repo, node.sha):
+            roots.append((node.sha, path))
+        for child in node.children.values():
+            nodes.append((child, child.name if not path else path + "/" + child.name))
+
+    ret = list()
+    seen = set()
+    stack = list(reversed(roots))
+    while stack:
+        sha, path = stack.pop()
+        if sha in seen:
+            continue
+        seen.add(sha)
+
+        raw = object_read_raw(repo, sha)
+        if raw is None:
+            raise Exception(f"Missing object {sha}")
+        fmt, data = raw
+        ret.append((sha, fmt, data, path))
+
+        match fmt:
+            case b'tag':
+                stack.append((kvlm_parse(data)[b'object'].decode("ascii"), ""))
+            case b'commit':
+                commit = GitCommit(data)
+                for p in commit_parents(commit):
+                    stack.append((p, ""))
+                stack.append((commit.kvlm[b'tree'].decode("ascii"), ""))
+            case b'tree':
+                for item in tree_parse(data):
+                    # Submodules point to commits in another repository.
+                    if not item.mode.startswith(b'16'):
+                        stack.append((item.sha, item.path))
+    return ret
+
+def delta_encode_size(size):
+    ret = bytearray()
+    while True:
+        c = size & 0x7f
+        size >>= 7
+        if size:
+            ret.append(c | 0x80)
+        else:
+            ret.append(c)
+            return ret
+
+DELTA_BLOCK = 16
+
+def delta_create(base, target, max_size=None):
+    """Build a git delta turning BASE into TARGET, or None if it would be
+    larger than MAX_SIZE."""
+    index = dict()
+    for i in range(len(base) - DELTA_BLOCK, -1, -DELTA_BLOCK):
+        index[base[i:i+DELTA_BLOCK]] = i
+
+    out = delta_encode_size(len(base)) + delta_encode_size(len(target))
+    pending = 0 # Start of bytes not yet emitted as an insert.
+    i = 0
+    end = len(target) - DELTA_BLOCK
+
+    def flush(stop):
+        nonlocal pending
+        while pending < stop:
+            n = min(stop - pending, 0x7f)
+            out.append(n)
+            out.extend(target[pending:pending+n])
+            pending += n
+
+    while i <= end:
+        offset = index.get(target[i:i+DELTA_BLOCK])
+        if offset is None:
+            i += 1
+            continue
+
+        # Extend the match forward, a page at a time then byte by byte.
+        j = offset + DELTA_BLOCK
+        k = i + DELTA_BLOCK
+        while k + 4096 <= len(target) and base[j:j+4096] == target[k:k+4096]:
+            j += 4096
+            k += 4096
+        while k < len(target) and j < len(base) and base[j] == target[k]:
+            j += 1
+            k += 1
+
+        flush(i)
+        size = k - i
+        while size:
+            n = min(size, 0xffffff)
+            cmd = 0x80
+            args = bytearray()
+            for b in range(4):
+                byte = (offset >> (8 * b)) & 0xff
+                if byte:
+                    cmd |= 1 << b
+                    args.append(byte)
+            for b in range(3):
+                byte = (n >> (8 * b)) & 0xff
+                if byte:
+                    cmd |= 0x10 << b
+                    args.append(byte)
+            out.append(cmd)
+            out.extend(args)
+            offset += n
+            size -= n
+        i = pending = k
+
+        if max_size is not None and len(out) > max_size:
+            return None
+
+    flush(len(target))
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+def pack_entry_header(type, size):
+    c = (type << 4) | (size & 0b1111)
+    size >>= 4
+    ret = bytearray()
+    while size:
+        ret.append(c | 0x80)
+        c = size & 0x7f
+        size >>= 7
+    ret.append(c)
+    return ret
+
+def pack_ofs_encode(rel):
+    ret = bytearray([rel & 0x7f])
+    rel >>= 7
+    while rel:
+        rel -= 1
+        ret.insert(0, 0x80 | (rel & 0x7f))
+        rel >>= 7
+    return ret
+
+def pack_write(repo, objects, window=10, depth=50):
+    """Write OBJECTS, (sha, fmt, data, path) tuples, as a new pack plus
+    its .idx.  Returns the pack path and the number of deltas."""
+    types = {v: k for k, v in PACK_OBJ_TYPES.items()}
+
+    # Like git, group objects by type and name so similar objects land
+    # in the same window, largest first so deltas mostly remove data.
+    order = sorted(objects,
+                   key=lambda o: (o[1], os.path.basename(o[3]), o[3], -len(o[2])))
+
+    pack_dir = repo_dir(repo, "objects", "pack", mkdir=True)
+    tmp_path = os.path.join(pack_dir, f"tmp_pack_{os.getpid()}")
+    checksum = hashlib.sha1()
+    offsets = dict()
+    crcs = dict()
+    chain = dict() # Delta chain length, per sha.
+    deltas = 0
+    recent = list()
+
+    with open(tmp_path, "wb") as f:
+        def emit(data):
+            checksum.update(data)
+            f.write(data)
+
+        emit(b"PACK" + (2).to_bytes(4, "big") + len(order).to_bytes(4, "big"))
+        pos = 12
+
+        for (sha, fmt, data, path) in order:
+            best = None
+            best_base = None
+            max_size = len(data) // 2 - 20
+            for (base_sha, base_fmt, base_data) in recent:
+                if base_fmt != fmt or chain[base_sha] >= depth or max_size <= 0:
+                    continue
+                # Bases much smaller than the target can't save much.
+                if len(base_data) < len(data) // 32:
+                    continue
+                delta = delta_create(base_data, data, max_size)
+                if delta is not None:
+                    best, best_base = delta, base_sha
+                    max_size = len(delta) - 1
+
+            if best is None:
+                entry = pack_entry_header(types[fmt], len(data)) + zlib.compress(data)
+                chain[sha] = 0
+            else:
+                entry = (pack_entry_header(PACK_OBJ_OFS_DELTA, len(best))
+                         + pack_ofs_encode(pos - offsets[best_base])
+                         + zlib.compress(best))
+                chain[sha] = chain[best_base] + 1
+                deltas += 1
+
+            offsets[sha] = pos
+            crcs[sha] = zlib.crc32(entry)
+            emit(entry)
+            pos += len(entry)
+
+            recent.append((sha, fmt, data))
+            if len(recent) > window:
+                recent.pop(0)
+
+        pack_sha = checksum.digest()
+        f.write(pack_sha)
+
+    name = os.path.join(pack_dir, f"pack-{pack_sha.hex()}")
+
+    shas = sorted(offsets.keys())
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i - 1]
+
+    idx = bytearray(b"\xfftOc" + (2).to_bytes(4, "big"))
+    idx += struct.pack(">256L", *fanout)
+    for sha in shas:
+        idx += bytes.fromhex(sha)
+    for sha in shas:
+        idx += crcs[sha].to_bytes(4, "big")
+    large = bytearray()
+    for sha in shas:
+        offset = offsets[sha]
+        if offset < 0x80000000:
+            idx += offset.to_bytes(4, "big")
+        else:
+            idx += (0x80000000 | (len(large) // 8)).to_bytes(4, "big")
+            large += offset.to_bytes(8, "big")
+    idx += large
+    idx += pack_sha
+    idx += hashlib.sha1(idx).digest()
+
+    with open(name + ".idx.tmp", "wb") as f:
+        f.write(idx)
+    os.replace(tmp_path, name + ".pack")
+    os.replace(name + ".idx.tmp", name + ".idx")
+
+    return name + ".pack", deltas
+
+# How long gc keeps unreachable objects, unless gc.pruneExpire says
+# otherwise.  Like git, two weeks.
+GC_PRUNE_EXPIRE = "2.weeks.ago"
+
+GC_PRUNE_UNITS = {"second": 1, "minute": 60, "hour": 3600, "day": 86400, "week": 7 * 86400}
+
+def gc_prune_cutoff(repo):
+    """The time before which gc may delete unreachable objects, from
+    gc.pruneExpire: "now", "never" (None) or "<n>.<unit>.ago"."""
+    value = repo.conf.get("gc", "pruneexpire", fallback=GC_PRUNE_EXPIRE).strip().lower()
+    if value == "never":
+        return None
+    if value == "now":
+        return time.time()
+    m = re.match(r"^(\d+)\.(second|minute|hour|day|week)s?\.ago$", value)
+    if not m:
+        raise Exception(f"Unsupported gc.pruneExpire: {value}")
+    return time.time() - int(m[1]) * GC_PRUNE_UNITS[m[2]]
+
+def gc_loosen(repo, pack, reachable):
+    """Write the objects of PACK that aren't in REACHABLE as loose ones,
+    dated like the pack so they expire when it would have.  Returns how
+    many it wrote."""
+    mtime = os.path.getmtime(pack.path)
+    ret = 0
+    for i in range(pack.count):
+        sha = pack.sha_at(i).hex()
+        if sha in reachable:
+            continue
+        path = repo_file(repo, "objects", sha[0:2], sha[2:], mkdir=True)
+        if os.path.exists(path):
+            continue
+        fmt, data = pack.read(pack.offset_at(i))
+        with open(path, 'wb') as f:
+            f.write(zlib.compress(fmt + b' ' + str(len(data)).encode() + b'\x00' + data))
+        os.utime(path, (mtime, mtime))
+        ret += 1
+    return ret
+
+def gc_prune_loose(repo, reachable, cutoff):
+    """Delete unreachable loose objects older than CUTOFF, returning how
+    many."""
+    ret = 0
+    objects = repo_dir(repo, "objects")
+    for d in os.listdir(objects):
+        if len(d) != 2:
+            continue
+        for f in os.listdir(os.path.join(objects, d)):
+            path = os.path.join(objects, d, f)
+            if len(f) == 38 and d + f not in reachable and os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+                ret += 1
+        try:
+            os.rmdir(os.path.join(objects, d))
+        except OSError:
+            pass # Fan-out directory still has objects.
+    return ret
+
+def gc(repo, window=10, depth=50):
+    """Pack every reachable object into a single pack, then delete the
+    loose objects and older packs it replaces.  Like git gc, unreachable
+    objects of the older packs are loosened rather than dropped, and
+    only unreachable loose objects older than gc.pruneExpire are
+    deleted."""
+    start = time.perf_counter()
+
+    objects = objects_reachable(repo)
+    if not objects:
+        print("Nothing to pack.")
+        return
+    reachable = {sha for (sha, _, _, _) in objects}
+    cutoff = gc_prune_cutoff(repo)
+
+    old_packs = list(pack_list(repo))
+    before = 0
+    for old in old_packs:
+        before += os.path.getsize(old.path) + os.path.getsize(old.path[:-5] + ".idx")
+
+    path, deltas = pack_write(repo, objects, window=window, depth=depth)
+    repo.packs = None
+    repo.sha_index = None
+
+    loosened = 0
+    for old in old_packs:
+        if old.path != path:
+            if cutoff is None or os.path.getmtime(old.path) >= cutoff:
+                loosened += gc_loosen(repo, old, reachable)
+            os.unlink(old.path)
+            os.unlink(old.path[:-5] + ".idx")
+
+    for (sha, _, _, _) in objects:
+        loose = repo_path(repo, "objects", sha[0:2], sha[2:])
+        if os.path.isfile(loose):
+            before += os.path.getsize(loose)
+            os.unlink(loose)
+            try:
+                os.rmdir(os.path.dirname(loose))
+            except OSError:
+                pass # Fan-out directory still has unpacked objects.
+
+    pruned = gc_prune_loose(repo, reachable, cutoff) if cutoff is not None else 0
+
+    after = os.path.getsize(path) + os.path.getsize(path[:-5] + ".idx")
+    elapsed = time.perf_counter() - start
+
+    print(f"Packed {len(objects)} objects ({deltas} deltas) into {os.path.basename(path)}")
+    if loosened or pruned:
+        print(f"Kept {loosened} unreachable objects loose, pruned {pruned} expired ones")
+    print(f"{before} bytes before, {after} bytes after, saved {before - after} bytes in {elapsed:.2f}s")
+
+
+def cmd_commit_graph(args):
+    repo = repo_find()
+    match args.action:
+        case "write":
+            commit_graph_write(repo, changed_paths=args.changed_paths)
+
+def commits_reachable(repo):
+    """Map every commit reachable from refs and HEAD to (tree, parents,
+    date).  Annotated tags are peeled; tags of non-commits are skipped."""
+    ret = dict()
+    stack = list()
+    for sha in ref_tips(repo):
+        obj = object_read(repo, sha)
+        while obj is not None and obj.fmt == b'tag':
+            sha = obj.kvlm[b'object'].decode("ascii")
+            obj = object_read(repo, sha)
+        if obj is not None and obj.fmt == b'commit':
+            stack.append(sha)
+
+    while stack:
+        sha = stack.pop()
+        if sha in ret:
+            continue
+        commit = object_read(repo, sha)
+        parents = commit_parents(commit)
+        ret[sha] = (commit.kvlm[b'tree'].decode("ascii"), parents, commit_date(commit))
+        stack.extend(p for p in parents if p not in ret)
+    return ret
+
+def commit_generations(commits):
+    """Topological level of each commit: 1 for roots, otherwise one more
+    than its highest parent.  COMMITS is the commits_reachable map."""
+    gen = dict()
+    for sha in commits:
+        stack = [sha]
+        while stack:
+            cur = stack[-1]
+            if cur in gen:
+                stack.pop()
+                continue
+            parents = commits[cur][1]
+            missing = [p for p in parents if p not in gen]
+            if missing:
+                stack.extend(missing)
+            else:
+                gen[cur] = 1 + max((gen[p] for p in parents), default=0)
+                stack.pop()
+    return gen
+
+# Generation numbers are 30 bits wide in CDAT.
+GENERATION_MAX = 0x3fffffff
+
+def commit_graph_write(repo, changed_paths=False):
+    """Write objects/info/commit-graph for every commit reachable from
+    refs and HEAD.  With CHANGED_PATHS, or if the current graph has
+    them, include changed-path Bloom filters; those of commits already
+    in the current graph are copied rather than recomputed."""
+    start = time.perf_counter()
+    old = commit_graph_get(repo)
+    if old and old.bloom_table is not None:
+        changed_paths = True
+
+    commits = commits_reachable(repo)
+    gen = commit_generations(commits)
+    shas = sorted(commits)
+    position = {sha: i for i, sha in enumerate(shas)} # Graph position of each commit
+
+    fanout = [0] * 256
+    for sha in shas:
+        fanout[int(sha[0:2], 16)] += 1
+    for i in range(1, 256):
+        fanout[i] += fanout[i-1]
+
+    oidl = b"".join(bytes.fromhex(sha) for sha in shas)
+
+    cdat = bytearray()
+    edge = bytearray()
+    for sha in shas:
+        tree, parents, date = commits[sha]
+        cdat += bytes.fromhex(tree)
+        ppos = [position[p] for p in parents]
+        if not ppos:
+            cdat += struct.pack(">LL", GRAPH_PARENT_NONE, GRAPH_PARENT_NONE)
+        elif len(ppos) == 1:
+            cdat += struct.pack(">LL", ppos[0], GRAPH_PARENT_NONE)
+        elif len(ppos) == 2:
+            cdat += struct.pack(">LL", ppos[0], ppos[1])
+        else:
+            cdat += struct.pack(">LL", ppos[0], GRAPH_EXTRA_EDGES | (len(edge) // 4))
+            for p in ppos[1:-1]:
+                edge += struct.pack(">L", p)
+            edge += struct.pack(">L", GRAPH_EXTRA_EDGES | ppos[-1])
+        generation = min(gen[sha], GENERATION_MAX)
+        cdat += struct.pack(">LL", (generation << 2) | ((date >> 32) & 0b11), date & 0xffffffff)
+
+    chunks = [(b"OIDF", struct.pack(">256L", *fanout)),
+              (b"OIDL", oidl),
+              (b"CDAT", bytes(cdat))]
+    if edge:
+        chunks.append((b"EDGE", bytes(edge)))
+
+    computed = 0
+    if changed_paths:
+        bidx = bytearray()
+        bdat = bytearray(struct.pack(">LLL", 1, BLOOM_HASHES, BLOOM_BITS_PER_ENTRY))
+        for sha in shas:
+            filter = None
+            if old and old.bloom_table is not None \
+               and (old.bloom_hashes, old.bloom_bits) == (BLOOM_HASHES, BLOOM_BITS_PER_ENTRY):
+                old_pos = old.find(sha)
+                if old_pos is not None:
+                    filter = old.bloom_at(old_pos)
+            if filter is None:
+                tree, parents, _ = commits[sha]
+                filter = bloom_filter_compute(repo, commits[parents[0]][0] if parents else None, tree)
+                computed += 1
+            bdat += filter
+            bidx += struct.pack(">L", len(bdat) - 12)
+        chunks.append((b"BIDX", bytes(bidx)))
+        chunks.append((b"BDAT", bytes(bdat)))
+
+    data = commit_graph_serialize(chunks)
+    path = repo_path(repo, "objects", "info", "commit-graph")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    lockfile_write(path, data, fsync=repo_fsync(repo, "commit-graph"))
+    repo.commit_graph = None
+
+    elapsed = time.perf_counter() - start
+    print(f"Wrote commit-graph with {len(shas)} commits in {elapsed:.2f}s")
+    if changed_paths:
+        print(f"Computed {computed} changed-path filters, reused {len(shas) - computed}")
+
+def tree_changed_paths(repo, old, new, limit=None):
+    """Paths of the files that differ between trees OLD and NEW (either
+    may be None, the empty tree).  Returns None once more than LIMIT
+    files differ."""
+    ret = list()
+    for path, _, _ in tree_diff(repo, old, new):
+        ret.append(path)
+        if limit is not None and len(ret) > limit:
+            return None
+    return ret
+
+def bloom_filter_compute(repo, parent_tree, tree):
+    """The changed-path filter of a commit with root TREE whose first
+    parent has PARENT_TREE (None for a root commit)."""
+    files = tree_changed_paths(repo, parent_tree, tree, limit=BLOOM_MAX_CHANGES)
+
+    paths = set()
+    if files is not None:
+        for path in files:
+            # The file and each of its leading directories.
+            while path and path not in paths:
+                paths.add(path)
+                path = path.rpartition("/")[0]
+
+    if files is None or len(paths) > BLOOM_MAX_CHANGES:
+        return b"\xff"
+
+    filter = bytearray(max(1, (len(paths) * BLOOM_BITS_PER_ENTRY + 7) // 8))
+    for path in paths:
+        bloom_add(filter, bloom_key(path))
+    return bytes(filter)
+
+def commit_graph_serialize(chunks):
+    """Header, chunk table and CHUNKS (a list of (id, data)), followed by
+    the SHA-1 of all that."""
+    data = bytearray(b"CGPH")
+    data += bytes([1, 1, len(chunks), 0])
+
+    offset = 8 + 12 * (len(chunks) + 1)
+    for id, chunk in chunks:
+        data += struct.pack(">4sQ", id, offset)
+        offset += len(chunk)
+    data += struct.pack(">4sQ", b"\0\0\0\0", offset)
+
+    for _, chunk in chunks:
+        data += chunk
+    data += hashlib.sha1(data).digest()
+    return bytes(data)